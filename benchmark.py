@@ -0,0 +1,212 @@
+# 性能基准：不需要真实仪表，采集部分使用仿真总线 (SIM 串口)，可在任意 Linux/Windows 电脑上运行。
+#   python benchmark.py                    完整测试
+#   python benchmark.py --quick            缩小数据量，约半分钟
+#   python benchmark.py --save base.json   保存结果
+#   python benchmark.py --compare base.json   与保存的结果对比，变慢超过 25% 的项目标出并返回非 0
+import importlib.util
+import argparse
+import json
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def load_app():
+    """主程序文件名是中文，按路径导入 (不会启动界面)"""
+    spec = importlib.util.spec_from_file_location("yudian", os.path.join(HERE, "宇电温度采集软件.py"))
+    m = importlib.util.module_from_spec(spec); spec.loader.exec_module(m)
+    return m
+
+m = load_app()
+results = {}    # 项目名 -> 数值 (越小越好)
+
+def report(name, value, unit):
+    results[name] = value
+    print(f"  {name:<40} {value:>10.2f} {unit}")
+
+def median_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter(); fn(); times.append(time.perf_counter() - t)
+    return sorted(times)[len(times) // 2]
+
+# ================= 轮询周期 =================
+def bench_poll(counts, cycles):
+    print("轮询周期 (9600 波特仿真总线，仪表延迟 5ms)")
+    for proto in ("AIBUS", "MODBUS"):
+        for n in counts:
+            w = m.BusWorker(f"SIM:addrs={n}", None, None); w.open_serial()
+            jobs = [(a, proto) for a in range(1, n + 1)]
+            w.poll(jobs)    # 第一轮用最长超时探测，不计入
+            report(f"poll {proto} {n} 台", median_time(lambda: w.poll(jobs), cycles) * 1000, "ms")
+    # 2 台离线：前两轮等满超时，之后退避，不再拖慢整条总线
+    w = m.BusWorker("SIM:addrs=8", None, None); w.open_serial()
+    jobs = [(a, "AIBUS") for a in range(1, 11)]
+    for _ in range(3): w.poll(jobs)
+    report("poll AIBUS 10 台 (2 台离线, 退避后)", median_time(lambda: w.poll(jobs), cycles) * 1000, "ms")
+
+# ================= 调度 =================
+def bench_schedule(seconds):
+    """不同采样周期的仪表共用一条总线：实际采样率、调度延迟和错过的周期"""
+    print(f"按截止时间调度 ({seconds} 秒，2 台 0.2s + 4 台 1s + 4 台 10s)")
+    jobs = [(a, "AIBUS", 0.2) for a in (1, 2)] + [(a, "AIBUS", 1.0) for a in range(3, 7)] + [(a, "MODBUS", 10.0) for a in range(7, 11)]
+    samples = []
+    w = m.BusWorker("SIM:addrs=10", lambda: jobs, samples.extend); w.start()
+    time.sleep(seconds); w.stop(); w.join()
+    expected = sum(seconds / interval for _, _, interval in jobs)
+    print(f"  {'采样数 (实际/按周期应有)':<40} {len(samples):>10d} / {expected:.0f}")
+    lag = m.metrics.series("yudian_schedule_lag_seconds")[0][1]
+    report("schedule 调度延迟 P95", lag.quantile(0.95) * 1000, "ms")
+    report("schedule 错过周期", sum(v for _, v in m.metrics.series("yudian_missed_samples_total")), "次")
+
+# ================= 存储压缩 =================
+def bench_compression(hours):
+    """定值附近小幅噪声 + 台阶 + 缓慢升温的通道：写库点数比例和还原误差 (容差 0.1°C，最大间隔 60 秒)"""
+    print(f"存储压缩 ({hours} 小时，每秒 1 点)")
+    rng = m.np.random.default_rng(0)
+    n = int(hours * 3600); t = 1.7e9 + m.np.arange(n, dtype=float)
+    sig = 25.0 + 2.0 * (m.np.arange(n) // 14400) + m.np.clip((m.np.arange(n) - n / 2) / 3600, 0, 1) * 10
+    sig = m.np.round(sig + rng.normal(0, 0.02, n), 1)
+    for mode in m.COMPRESSION_MODES:
+        c = m.make_compressor((mode, 0.1, 60.0)); stored = []
+        t0 = time.perf_counter()
+        for ts, v in zip(t.tolist(), sig.tolist()): stored.extend(c.add(ts, v))
+        stored.extend(c.flush())
+        elapsed = time.perf_counter() - t0
+        stored = [(ts, round(v, 1)) for ts, v in stored]     # 库中温度精度 0.1°C
+        rec = m.reconstruct(stored, t[0] - 1, t[-1], 1.0, 60.0)
+        err = m.np.abs(m.np.array([r[1] for r in rec]) - sig[m.np.searchsorted(t, [r[0] for r in rec])])
+        report(f"compress {mode} 写库比例", len(stored) / n * 100, "%")
+        report(f"compress {mode} 最大还原误差", float(err.max()), "°C")
+        report(f"compress {mode} 每点耗时", elapsed / n * 1e6, "us")
+
+# ================= 报警 =================
+def bench_alarms(counts, seconds):
+    """每路都开启上下限/变化率/卡死报警，按秒成批送入：单个样本的判断耗时应与通道数无关"""
+    print(f"报警判断 ({seconds} 秒数据)")
+    for n in counts:
+        insts = [{"addr": a, "alarm_high": 80, "alarm_low": 0, "alarm_rate": 5, "alarm_stuck": 600} for a in range(1, n + 1)]
+        e = m.AlarmEngine(); e.configure(insts, 1.7e9)
+        batches = [[(1.7e9 + s, a, m.Reading(25.0 + (s + a) % 7 / 10, 30.0, 10, 0)) for a in range(1, n + 1)] for s in range(seconds)]
+        t = time.perf_counter()
+        for b in batches: e.feed(b)
+        report(f"alarm {n} 路 每样本", (time.perf_counter() - t) / (n * seconds) * 1e6, "us")
+
+# ================= SQLite 写入 =================
+def bench_ingest(db_path, channels, hours):
+    """按实际节奏 (每秒每路一行) 把 hours 小时数据放入写队列，计算写线程落盘速度"""
+    print(f"SQLite 写入 ({channels} 路 x {hours} 小时)")
+    db = m.Database(db_path)
+    end = time.time(); start = end - hours * 3600
+    t = time.perf_counter()
+    for s in range(int(hours * 3600)):
+        ts = start + s
+        db.put([(ts, addr, 25.0 + addr + (s % 600) / 100.0) for addr in range(1, channels + 1)])
+    done = threading.Event(); db.submit(lambda conn: done.set())    # 写线程先写完队列中已有的数据才会执行到这里
+    done.wait()
+    elapsed = time.perf_counter() - t
+    db.close()
+    report("ingest 耗时", elapsed, "s")
+    print(f"  {'ingest 速度':<40} {channels * hours * 3600 / elapsed:>10.0f} 行/s")
+    return start, end
+
+# ================= 曲线数据 =================
+def bench_plot(channels, repeat):
+    """App.get_plot_data 只依赖服务的内存缓冲，这里用填满的缓冲和假的绘图范围直接调用"""
+    print(f"get_plot_data ({channels} 路，缓冲已填满)")
+    now = time.time()
+    service = types.SimpleNamespace(buffers={}, rollups={})
+    instruments = []
+    for addr in range(1, channels + 1):
+        buf = m.RingBuffer(m.RAW_PLOT_SECONDS)
+        ts = now - m.RAW_PLOT_SECONDS + m.np.arange(m.RAW_PLOT_SECONDS)
+        buf.extend(ts, 25.0 + m.np.sin(ts / 600.0))
+        rollup = m.ChannelRollup()
+        for level, rbuf in rollup.buffers.items():
+            ts = (now // level - rbuf.capacity + m.np.arange(rbuf.capacity)) * level + level / 2
+            v = 25.0 + m.np.sin(ts / 600.0)
+            rbuf.extend(ts, m.np.column_stack([v - 0.5, v + 0.5, v]))
+        service.buffers[addr] = buf; service.rollups[addr] = rollup
+        instruments.append({"addr": addr, "name": f"{addr}号仪表", "color": "#ff0000"})
+    for label, val, unit, unit_sec in (("10 分钟", 10, "分钟", 60.0), ("1 小时", 1, "小时", 3600.0), ("6 小时", 6, "小时", 3600.0),
+                                      ("1 天", 24, "小时", 3600.0), ("7 天", 168, "小时", 3600.0)):
+        app = types.SimpleNamespace(service=service, instruments=instruments, plot_window=lambda v=val, u=unit, s=unit_sec: (v, u, s))
+        report(f"get_plot_data {label}", median_time(lambda: m.App.get_plot_data(app), repeat) * 1000, "ms")
+
+# ================= 冷数据归档 =================
+def bench_archive(tmp, channels, days):
+    """直接生成 days 天、每秒 1 点的归档文件，读取其中一路整段数据 (内存映射，不读其它通道)"""
+    print(f"冷数据归档 ({channels} 路 x {days} 天)")
+    db = m.Database(os.path.join(tmp, "archive.db"), os.path.join(tmp, "archive"))
+    base = m.day_bounds(m.day_key(time.time() - (days + 30) * 86400))[0]
+    n = 86400
+    for d in range(days):
+        a = m.day_bounds(m.day_key(base + d * 86400 + 3600))[0]
+        ts = int(a * 1000) + m.np.arange(n, dtype=m.np.int64) * 1000
+        db.archive.write_day(m.day_key(a), {addr: (ts, (250 + addr + m.np.arange(n) % 50).astype(m.np.int16)) for addr in range(1, channels + 1)})
+    t_end = base + days * 86400
+    report(f"archive 读取 1 路 {days} 天", median_time(lambda: db.fetch_arrays(1, base, t_end), 5) * 1000, "ms")
+    report(f"archive 600秒汇总 1 路 {days} 天", median_time(lambda: db.fetch_rollup(1, 600, base, t_end), 5) * 1000, "ms")
+    db.close()
+
+# ================= 导出 =================
+def bench_export(db_path, start, end, hours_list, tmp):
+    print("导出 (时间不含内存跟踪开销，内存为 tracemalloc 峰值)")
+    db = m.Database(db_path)
+    columns = [(addr, f"{addr}号仪表") for addr in db.addresses(start, end)]
+    formats = [".csv", ".csv.gz"]
+    try:
+        import pyarrow
+        formats.append(".parquet")
+    except ImportError: print("  (未安装 pyarrow，跳过 parquet)")
+    for hours in hours_list:
+        for ext in formats:
+            path = os.path.join(tmp, "export" + ext)
+            def run():
+                e = m.Exporter(db, path, columns, end - hours * 3600, end); e.run()
+                if e.error is not None: raise e.error
+            report(f"export {hours}h {ext} 耗时", median_time(run, 1), "s")
+            tracemalloc.start(); run(); peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+            report(f"export {hours}h {ext} 内存", peak / 1e6, "MB")
+    db.close()
+
+def compare(path, tolerance=1.25):
+    with open(path, encoding="utf-8") as f: base = json.load(f)
+    worse = [(k, base[k], v) for k, v in results.items() if k in base and base[k] > 0 and v > base[k] * tolerance]
+    print(f"与 {path} 对比：" + ("无明显退化" if not worse else f"{len(worse)} 项变慢"))
+    for k, old, new in worse: print(f"  {k:<40} {old:>10.2f} -> {new:.2f}")
+    return not worse
+
+def main():
+    parser = argparse.ArgumentParser(description="宇电温度采集软件 性能基准")
+    parser.add_argument("--quick", action="store_true", help="缩小数据量")
+    parser.add_argument("--save", help="把结果保存为 JSON")
+    parser.add_argument("--compare", help="与保存的 JSON 结果对比")
+    args = parser.parse_args()
+    channels = 10
+    hours = 2 if args.quick else 24
+    tmp = tempfile.mkdtemp(prefix="yudian_bench_")
+    try:
+        db_path = os.path.join(tmp, "bench.db")
+        bench_poll((1, 5, 10) if args.quick else (1, 5, 10, 20, 32), 3 if args.quick else 5)
+        bench_schedule(3 if args.quick else 10)
+        bench_compression(6 if args.quick else 24)
+        bench_alarms((10, 100, 1000), 60 if args.quick else 600)
+        start, end = bench_ingest(db_path, channels, hours)
+        bench_plot(channels, 5 if args.quick else 20)
+        bench_archive(tmp, channels, 7 if args.quick else 30)
+        bench_export(db_path, start, end, (1, 2) if args.quick else (1, 6, 24), tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare and not compare(args.compare): sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,35 @@
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog, colorchooser
 import serial
-import serial.tools.list_ports
 import sqlite3
-import pandas as pd
 from datetime import datetime, timedelta
 import threading
+import queue
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict, deque
 import time
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib
+import math
+import random
+import numpy as np
 import json
+import csv
+import gzip
+import logging
 import os
-import pystray
-from PIL import Image, ImageDraw
-from pystray import MenuItem as item
+import sys
+import signal
+import argparse
+import bisect
+import socket
+import selectors
+import struct
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
-# --- 字体与显示配置 ---
-matplotlib.rcParams['font.sans-serif'] = ['SimHei', 'Microsoft YaHei', 'Arial']
-matplotlib.rcParams['axes.unicode_minus'] = False
+# tkinter / matplotlib / pystray / PIL 启动较慢且无界面采集用不到，只在对应功能第一次使用时导入
+tk = ttk = messagebox = filedialog = colorchooser = None
+
+def import_tk():
+    global tk, ttk, messagebox, filedialog, colorchooser
+    import tkinter as tk
+    from tkinter import ttk, messagebox, filedialog, colorchooser
 
 # 绘图区字体大小
 PLOT_TITLE_SIZE = 32
@@ -30,10 +41,1640 @@ DB_FILE = "multi_channel_history.db"
 CONFIG_FILE = "instruments_config.json"
 DATA_RETENTION_DAYS = 7     # 【修改】保留7天数据
 MAX_PLOT_POINTS = 1000      
+TREE_ROWS = 20              # 实时表格显示的行数
+
+log = logging.getLogger("yudian")
+
+# ================= 通讯协议层 =================
+INVALID_TEMP = -100.0       # 通讯失败时记录的温度
+
+# 一次读操作返回的全部状态 (温度单位 °C，MV 单位 %)
+Reading = namedtuple("Reading", "pv sv mv alarm")
+
+class ProtocolError(Exception):
+    """响应长度、地址、功能码或校验和不符。kind 供统计用: timeout / short_read / checksum / protocol"""
+    def __init__(self, msg, kind="protocol"):
+        super().__init__(msg)
+        self.kind = kind
+
+def length_error(resp):
+    return ProtocolError(f"应答长度 {len(resp)}", "short_read" if resp else "timeout")
+
+def _make_crc16_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _make_crc16_table()
+
+def crc16_modbus(data):
+    """MODBUS CRC16 (查表法，每字节一次查表)"""
+    crc = 0xFFFF
+    for b in data:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ b) & 0xFF]
+    return crc
+
+def _s16(v): return v - 65536 if v > 32767 else v
+def _s8(v): return v - 256 if v > 127 else v
+
+# --- AIBUS ---
+# 读指令: 80H+addr, 80H+addr, 52H, 参数代号, 0, 0, 校验(低,高)；校验 = 参数代号*256 + 52H + addr
+# 应答(10字节): PV, SV (16位小端), MV, 报警状态, 参数值, 校验；校验 = PV+SV+(报警*256+MV)+参数值+addr
+AIBUS_RESP_LEN = 10
+
+def aibus_read_cmd(addr, param=0x00):
+    chk = (param * 256 + 0x52 + addr) & 0xFFFF
+    header_byte = 0x80 + addr
+    return bytes([header_byte, header_byte, 0x52, param, 0x00, 0x00, chk & 0xFF, chk >> 8])
+
+def parse_aibus_response(addr, resp):
+    if len(resp) != AIBUS_RESP_LEN: raise length_error(resp)
+    words = [resp[i] + (resp[i + 1] << 8) for i in range(0, AIBUS_RESP_LEN, 2)]
+    if (sum(words[:4]) + addr) & 0xFFFF != words[4]: raise ProtocolError("校验和错误", "checksum")
+    return Reading(_s16(words[0]) / 10.0, _s16(words[1]) / 10.0, _s8(resp[4]), resp[5])
+
+# --- MODBUS-RTU ---
+# 宇电仪表从 0000H 起依次为 PV, SV, 报警状态*256+MV, 所读参数值，与 AIBUS 应答布局一致
+MODBUS_FIELDS = {"pv": 0x0000, "sv": 0x0001, "mv_alarm": 0x0002}
+MODBUS_MAX_REGS = 32        # 单次事务最多读的寄存器数
+
+def merge_register_ranges(ranges, max_count=MODBUS_MAX_REGS):
+    """把 [(起始, 个数), ...] 中相邻/重叠的区间合并成尽量少的读事务"""
+    merged = []
+    for start, count in sorted(ranges):
+        if merged:
+            m_start, m_count = merged[-1]
+            end = max(m_start + m_count, start + count)
+            if start <= m_start + m_count and end - m_start <= max_count:
+                merged[-1] = (m_start, end - m_start); continue
+        merged.append((start, count))
+    return merged
+
+def modbus_read_cmd(addr, start, count):
+    base_cmd = bytes([addr, 0x03, start >> 8, start & 0xFF, count >> 8, count & 0xFF])
+    crc = crc16_modbus(base_cmd)
+    return base_cmd + bytes([crc & 0xFF, crc >> 8])
+
+def modbus_resp_len(count): return 5 + 2 * count
+
+def parse_modbus_response(addr, resp, count):
+    """校验 0x03 应答并返回寄存器值列表"""
+    if len(resp) != modbus_resp_len(count): raise length_error(resp)
+    if resp[0] != addr: raise ProtocolError(f"地址不符 {resp[0]}")
+    if resp[1] != 0x03 or resp[2] != 2 * count: raise ProtocolError("功能码或字节数不符")
+    if crc16_modbus(resp[:-2]) != resp[-2] + (resp[-1] << 8): raise ProtocolError("CRC 错误", "checksum")
+    return [(resp[3 + 2 * i] << 8) + resp[4 + 2 * i] for i in range(count)]
+
+def decode_modbus_reading(regs):
+    """regs: {寄存器地址: 值}"""
+    mv_alarm = regs[MODBUS_FIELDS["mv_alarm"]]
+    return Reading(_s16(regs[MODBUS_FIELDS["pv"]]) / 10.0, _s16(regs[MODBUS_FIELDS["sv"]]) / 10.0,
+                   _s8(mv_alarm & 0xFF), mv_alarm >> 8)
+
+# ================= 仿真总线 =================
+# 串口名以 SIM 开头时不打开真实串口，由 SimulatedSerial 按仪表协议应答，用于没有仪表时调试和性能测试。
+# 参数写在串口名中，例如 SIM:addrs=10,latency=0.02,drop=0.05,corrupt=0.01
+#   addrs   在线仪表台数 (地址 1..addrs 应答)     latency 仪表处理延迟 (秒)
+#   drop    不应答的概率     corrupt 应答中有一位出错的概率
+#   baud    模拟线路传输时间的波特率，0 表示不计传输时间     seed 随机种子
+SIM_PREFIX = "SIM"
+
+def is_sim_port(port): return port.upper().startswith(SIM_PREFIX)
+
+class SimulatedSerial:
+    """模拟挂着若干台宇电仪表的 RS485 总线，提供 BusWorker 用到的 serial.Serial 接口"""
+
+    def __init__(self, port, timeout=None):
+        opts = {"addrs": 10, "latency": 0.005, "drop": 0.0, "corrupt": 0.0, "baud": 9600, "seed": None}
+        for part in port.partition(":")[2].split(","):
+            if "=" in part:
+                k, v = part.split("=", 1); opts[k.strip()] = float(v)
+        self.port = port; self.timeout = timeout; self.is_open = True
+        self.addrs = int(opts["addrs"]); self.latency = opts["latency"]
+        self.drop = opts["drop"]; self.corrupt = opts["corrupt"]; self.baud = opts["baud"]
+        self.rng = random.Random(opts["seed"])
+        self.pending = None         # (应答就绪时刻, 应答字节)
+
+    def wire_time(self, n):
+        return n * 10.0 / self.baud if self.baud else 0.0    # 8N1 每字节 10 位
+
+    def values(self, addr):
+        """某台仪表当前的 (PV, SV, MV, 报警状态)，PV 单位 0.1°C，缓慢正弦变化加噪声"""
+        t = time.time()
+        pv = int(round((25.0 + addr + 5.0 * math.sin(2 * math.pi * t / 600.0 + addr) + self.rng.gauss(0, 0.05)) * 10))
+        return pv, 250 + addr * 10, 50, 0
+
+    def respond(self, cmd):
+        """按指令生成应答；不认识的指令或离线地址返回 None"""
+        if len(cmd) == 8 and cmd[0] == cmd[1] and cmd[0] >= 0x80 and cmd[2] == 0x52:
+            addr = cmd[0] - 0x80
+            if not 1 <= addr <= self.addrs or cmd != aibus_read_cmd(addr, cmd[3]): return None
+            pv, sv, mv, alarm = self.values(addr)
+            words = [pv & 0xFFFF, sv & 0xFFFF, (alarm << 8) | (mv & 0xFF), 0]
+            words.append((sum(words) + addr) & 0xFFFF)
+            return bytes(b for w in words for b in (w & 0xFF, w >> 8))
+        if len(cmd) == 8 and cmd[1] == 0x03 and crc16_modbus(cmd[:6]) == cmd[6] + (cmd[7] << 8):
+            addr = cmd[0]; start = (cmd[2] << 8) + cmd[3]; count = (cmd[4] << 8) + cmd[5]
+            if not 1 <= addr <= self.addrs: return None
+            pv, sv, mv, alarm = self.values(addr)
+            regs = {MODBUS_FIELDS["pv"]: pv & 0xFFFF, MODBUS_FIELDS["sv"]: sv & 0xFFFF, MODBUS_FIELDS["mv_alarm"]: (alarm << 8) | (mv & 0xFF)}
+            body = bytes([addr, 0x03, 2 * count]) + b"".join(bytes([v >> 8, v & 0xFF]) for v in (regs.get(start + i, 0) for i in range(count)))
+            crc = crc16_modbus(body)
+            return body + bytes([crc & 0xFF, crc >> 8])
+        return None
+
+    def write(self, data):
+        data = bytes(data); resp = self.respond(data); self.pending = None
+        if resp is not None and self.rng.random() >= self.drop:
+            if self.rng.random() < self.corrupt:
+                resp = bytearray(resp); resp[self.rng.randrange(len(resp))] ^= 1 << self.rng.randrange(8); resp = bytes(resp)
+            self.pending = (time.monotonic() + self.wire_time(len(data)) + self.latency + self.wire_time(len(resp)), resp)
+        return len(data)
+
+    def read(self, size=1):
+        """与 pyserial 一致：收满 size 字节立即返回，否则等满超时返回已收到的部分"""
+        deadline = time.monotonic() + (self.timeout or 0.0)
+        pending, self.pending = self.pending, None
+        if pending is not None and pending[0] <= deadline and len(pending[1]) >= size:
+            time.sleep(max(0.0, pending[0] - time.monotonic()))
+            return pending[1][:size]
+        time.sleep(max(0.0, deadline - time.monotonic()))
+        return pending[1] if pending is not None and pending[0] <= deadline else b""
+
+    def flushInput(self): self.pending = None
+
+    def close(self): self.is_open = False
+
+# ================= 运行指标 =================
+# 采集、存储、界面各环节的计数和耗时分布：界面"帮助 -> 诊断信息"中查看，
+# 同时以 Prometheus 文本格式发布在 http://127.0.0.1:<端口>/metrics (--metrics-port 0 关闭)
+METRICS_PORT = 9108
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)    # 秒
+METRIC_HELP = {
+    "yudian_read_seconds": ("histogram", "单台仪表一次读取的往返时间"),
+    "yudian_read_errors_total": ("counter", "读取失败次数，kind: timeout 无应答 / short_read 应答不完整 / checksum 校验错 / protocol 格式错 / serial 串口异常"),
+    "yudian_read_skipped_total": ("counter", "退避期间跳过的读取次数"),
+    "yudian_schedule_lag_seconds": ("histogram", "仪表实际读取时刻比计划时刻晚了多少"),
+    "yudian_missed_samples_total": ("counter", "总线忙不过来而跳过的采样周期数"),
+    "yudian_bus_busy_seconds_total": ("counter", "总线用于读仪表的累计时间"),
+    "yudian_db_commit_seconds": ("histogram", "写线程一次批量写入并提交的耗时"),
+    "yudian_db_rows_total": ("counter", "写入的原始样本行数"),
+    "yudian_db_errors_total": ("counter", "写入失败次数 (批量写入和提交给写线程的任务)"),
+    "yudian_compressed_samples_total": ("counter", "开启压缩的仪表中未写入数据库的样本数"),
+    "yudian_ui_render_seconds": ("histogram", "界面刷新各部分的耗时，part: tree 表格 / plot 曲线 / history 历史浏览"),
+    "yudian_ui_errors_total": ("counter", "界面刷新出错次数"),
+    "yudian_pubsub_frames_total": ("counter", "实时发布的帧数，result: sent 已发送 / dropped 客户端积压过多被丢弃"),
+    "yudian_pubsub_connections_total": ("counter", "实时发布服务接受的连接数"),
+    "yudian_alarms_total": ("counter", "触发的报警次数"),
+    "yudian_tile_requests_total": ("counter", "历史浏览读取数据块次数，result: hit 命中缓存 / miss 查询数据库"),
+}
+
+class Histogram:
+    """固定分桶的耗时分布，另记总和与最大值"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # 最后一桶为 +Inf
+        self.count = 0; self.sum = 0.0; self.max = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.count += 1; self.sum += v; self.max = max(self.max, v)
+
+    def mean(self): return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """按分桶估计分位数 (取所在桶的上界)"""
+        acc = 0
+        for b, c in zip(self.buckets, self.counts):
+            acc += c
+            if acc >= q * self.count: return min(b, self.max)
+        return self.max
+
+class Metrics:
+    """线程安全的计数器/直方图集合，同名指标按标签区分"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}          # (名称, 标签) -> 计数
+        self.histograms = {}        # (名称, 标签) -> Histogram
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None: h = self.histograms[key] = Histogram()
+            h.observe(value)
+
+    def series(self, name):
+        """某指标的全部序列 [(标签 dict, 计数或 Histogram), ...] (直方图为副本)"""
+        out = []
+        with self.lock:
+            for (n, labels), v in self.counters.items():
+                if n == name: out.append((dict(labels), v))
+            for (n, labels), h in self.histograms.items():
+                if n == name:
+                    c = Histogram(h.buckets); c.counts = list(h.counts); c.count = h.count; c.sum = h.sum; c.max = h.max
+                    out.append((dict(labels), c))
+        return out
+
+    def prometheus(self):
+        """Prometheus 文本格式 (0.0.4)"""
+        def fmt(labels, extra=()):
+            items = [(k, str(v)) for k, v in labels] + list(extra)
+            if not items: return ""
+            return "{" + ",".join('%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in items) + "}"
+        lines = []
+        with self.lock:
+            for name, (kind, text) in METRIC_HELP.items():
+                lines.append(f"# HELP {name} {text}"); lines.append(f"# TYPE {name} {kind}")
+                if kind == "counter":
+                    for (n, labels), v in sorted(self.counters.items()):
+                        if n == name: lines.append(f"{name}{fmt(labels)} {v}")
+                    continue
+                for (n, labels), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+                    if n != name: continue
+                    acc = 0
+                    for b, c in zip(h.buckets + ("+Inf",), h.counts):
+                        acc += c; lines.append(f"{name}_bucket{fmt(labels, [('le', str(b))])} {acc}")
+                    lines.append(f"{name}_sum{fmt(labels)} {h.sum:.6f}"); lines.append(f"{name}_count{fmt(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics": self.send_error(404); return
+        body = metrics.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers(); self.wfile.write(body)
+
+    def log_message(self, *args): pass
+
+def start_metrics_server(port):
+    """只监听本机回环地址；端口被占用时记日志后继续采集"""
+    try: server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    except OSError as e:
+        log.warning("指标端口 %d 不可用: %s", port, e); return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("运行指标: http://127.0.0.1:%d/metrics", port)
+    return server
+
+# ================= 核心通讯函数 =================
+POLL_INTERVAL = 1.0         # 默认采样周期 (秒)，仪表配置中可用 interval 单独指定
+MIN_INTERVAL = 0.1          # 最短采样周期，9600 波特下一次读取约 25ms
+SCHEDULER_MAX_SLEEP = 0.5   # 空闲等待上限，以便及时响应配置变化和停止
+WORKER_JOIN_TIMEOUT = 3.0   # 停止时等待采集线程退出的时间 (空闲时最长睡 1 秒，一次读取最长 0.2 秒)
+
+def inst_interval(inst):
+    try: return max(MIN_INTERVAL, float(inst.get('interval') or POLL_INTERVAL))
+    except (TypeError, ValueError): return POLL_INTERVAL
+SERIAL_TIMEOUT_MAX = 0.2    # 首次/重新探测时的应答超时 (秒)
+SERIAL_TIMEOUT_MIN = 0.03   # 自适应超时下限，9600 波特下 10 字节约需 10ms
+BACKOFF_AFTER = 2           # 连续失败几次后开始退避
+BACKOFF_MAX = 60.0          # 最长退避间隔 (秒)
+
+class AddrHealth:
+    """单个地址的通讯健康状态。
+    超时按实测应答延迟自适应 (平均值 + 4 倍偏差，类似 TCP RTO)；连续无应答则按 2,4,8...秒
+    指数退避，退避期间不占总线时间，避免一台掉线仪表拖慢整条总线。"""
+
+    def __init__(self):
+        self.fails = 0
+        self.retry_at = 0.0         # time.monotonic() 到此之前跳过轮询
+        self.latency = None         # 应答延迟平滑值，None 表示未知
+        self.latency_dev = 0.0
+
+    def should_poll(self, now):
+        return now >= self.retry_at
+
+    def timeout(self):
+        if self.latency is None: return SERIAL_TIMEOUT_MAX
+        return min(SERIAL_TIMEOUT_MAX, max(SERIAL_TIMEOUT_MIN, self.latency + 4 * self.latency_dev))
+
+    def ok(self, latency):
+        if self.latency is None:
+            self.latency = latency; self.latency_dev = latency / 2
+        else:
+            self.latency_dev = 0.75 * self.latency_dev + 0.25 * abs(latency - self.latency)
+            self.latency = 0.875 * self.latency + 0.125 * latency
+        self.fails = 0; self.retry_at = 0.0
+
+    def fail(self, now):
+        # 失败后下一次用最长超时重新探测，防止自适应超时过短造成误判
+        self.latency = None
+        self.fails += 1
+        if self.fails >= BACKOFF_AFTER:
+            self.retry_at = now + min(BACKOFF_MAX, 2.0 ** (self.fails - BACKOFF_AFTER + 1))
+
+class BusWorker(threading.Thread):
+    """单条 RS485 总线的采集线程：独占一个串口，只轮询挂在该口上的仪表。
+    多个 USB-485 转换器各自一个 BusWorker，总线之间并行采集，互不拖慢。
+    总线内按截止时间调度：每台仪表有自己的采样周期，总是先读最早到期的一台。"""
+
+    def __init__(self, port, get_jobs, on_samples):
+        super().__init__(daemon=True)
+        self.port = port
+        self.get_jobs = get_jobs        # () -> [(addr, 协议, 采样周期秒), ...] 当前挂在本口上的仪表
+        self.on_samples = on_samples    # 批量回调 [(时间戳秒, addr, Reading 或 None), ...]
+        self.serial_conn = None
+        self.is_running = True
+        self.status = ("等待中...", "red")
+        self.health = {}                # addr -> AddrHealth
+
+    def stop(self):
+        self.is_running = False
+
+    def open_serial(self):
+        """打开(或复用)本总线的串口"""
+        try:
+            if self.serial_conn is not None and self.serial_conn.is_open:
+                return True
+            baud = 9600
+            if is_sim_port(self.port):
+                self.serial_conn = SimulatedSerial(self.port, timeout=SERIAL_TIMEOUT_MAX)
+            else:
+                self.serial_conn = serial.Serial(
+                    port=self.port,
+                    baudrate=baud,
+                    bytesize=8,
+                    parity=serial.PARITY_NONE,
+                    stopbits=1,
+                    timeout=SERIAL_TIMEOUT_MAX
+                )
+            self.status = (f"{self.port} 已开", "green")
+            log.info("%s 已打开", self.port)
+            return True
+        except Exception as e:
+            status = (f"{self.port} 错误: {e}", "red")
+            if status != self.status: log.warning("%s 打开失败: %s", self.port, e)  # 重试期间只在状态变化时记一次
+            self.status = status
+            self.serial_conn = None
+            return False
+
+    def close_serial(self):
+        try:
+            if self.serial_conn is not None: self.serial_conn.close()
+        except: pass
+        self.serial_conn = None
+
+    def transact(self, cmd, resp_len):
+        # read(n) 收满 n 字节立即返回，只有缺字节时才会等满超时
+        self.serial_conn.flushInput()
+        self.serial_conn.write(cmd)
+        return self.serial_conn.read(resp_len)
+
+    def read_reading(self, addr, proto):
+        """读一台仪表的 PV/SV/MV/报警状态；无应答或校验失败返回 None"""
+        if self.serial_conn is None: return None
+        h = self.health.setdefault(addr, AddrHealth())
+        t0 = time.monotonic()
+        if not h.should_poll(t0):
+            metrics.inc("yudian_read_skipped_total", port=self.port, addr=addr); return None
+        try:
+            # pyserial 每次给 timeout 赋值都会重新配置串口 (Windows 上是 SetCommTimeouts/SetCommState)，取整到毫秒且只在变化时设置
+            timeout = round(h.timeout(), 3)
+            if self.serial_conn.timeout != timeout: self.serial_conn.timeout = timeout
+            if proto == "AIBUS":
+                reading = parse_aibus_response(addr, self.transact(aibus_read_cmd(addr), AIBUS_RESP_LEN))
+            else:
+                reading = decode_modbus_reading(self.read_modbus_registers(addr, [(r, 1) for r in MODBUS_FIELDS.values()]))
+        except ProtocolError as e:
+            h.fail(time.monotonic()); metrics.inc("yudian_read_errors_total", port=self.port, addr=addr, kind=e.kind); return None
+        except:
+            h.fail(time.monotonic()); metrics.inc("yudian_read_errors_total", port=self.port, addr=addr, kind="serial"); return None
+        latency = time.monotonic() - t0
+        h.ok(latency); metrics.observe("yudian_read_seconds", latency, port=self.port, addr=addr)
+        return reading
+
+    def read_modbus_registers(self, addr, ranges):
+        """相邻寄存器合并成一次事务读取，返回 {寄存器地址: 值}"""
+        regs = {}
+        for start, count in merge_register_ranges(ranges):
+            resp = self.transact(modbus_read_cmd(addr, start, count), modbus_resp_len(count))
+            for i, v in enumerate(parse_modbus_response(addr, resp, count)): regs[start + i] = v
+        return regs
+
+    def read_sample(self, addr, proto):
+        """读一台仪表，时间戳取发出请求的时刻 -> (时间戳秒, addr, Reading 或 None)"""
+        ts = time.time(); t0 = time.monotonic()
+        reading = self.read_reading(addr, proto)
+        metrics.inc("yudian_bus_busy_seconds_total", time.monotonic() - t0, port=self.port)
+        return ts, addr, reading
+
+    def poll(self, jobs):
+        """不经调度把 jobs 中的仪表各读一遍 (基准测试用)"""
+        return [self.read_sample(addr, proto) for addr, proto, *_ in jobs if self.is_running]
+
+    def run(self):
+        # 下次到期时间在上次计划时刻上累加 (单调时钟)，读取本身的耗时不会累积成漂移；
+        # 总线忙不过来时跳过已经错过的周期，而不是事后连续补读
+        due = {}            # addr -> [下次到期 time.monotonic(), 采样周期]
+        pending = []        # 攒到每台仪表约一次或总线空闲时交给 on_samples
+        while self.is_running:
+            jobs = {addr: (proto, interval) for addr, proto, interval in self.get_jobs()}
+            for addr in set(due) - set(jobs): del due[addr]
+            if not jobs or not self.open_serial():
+                if pending: self.on_samples(pending); pending = []
+                time.sleep(1); continue
+            now = time.monotonic()
+            for addr, (proto, interval) in jobs.items():
+                if addr not in due or due[addr][1] != interval: due[addr] = [now, interval]
+            addr = min(due, key=lambda a: due[a][0])
+            wait = due[addr][0] - now
+            if wait > 0:
+                if pending: self.on_samples(pending); pending = []
+                time.sleep(min(wait, SCHEDULER_MAX_SLEEP)); continue
+            metrics.observe("yudian_schedule_lag_seconds", -wait, port=self.port)
+            pending.append(self.read_sample(addr, jobs[addr][0]))
+            slot = due[addr]; slot[0] += slot[1]
+            late = time.monotonic() - slot[0]
+            if late >= 0:
+                missed = int(late // slot[1]) + 1
+                slot[0] += missed * slot[1]; metrics.inc("yudian_missed_samples_total", missed, port=self.port, addr=addr)
+            if len(pending) >= len(jobs): self.on_samples(pending); pending = []
+        if pending: self.on_samples(pending)
+        self.close_serial()
+
+# ================= 数据压缩 =================
+# 可按仪表开启 (配置 compression = "deadband" 或 "swinging_door")：写库前只保留描述曲线形状所需的点，
+# 读取时按采样周期线性插值还原成等间隔序列。相邻存储点的间隔保证不超过 max_gap 秒，
+# 因此间隔更大的两点之间是停机/断线，不做插值。内存缓冲和汇总仍使用全部样本。
+COMPRESSION_MODES = ("deadband", "swinging_door")
+COMPRESSION_TOLERANCE = 0.1     # 默认容差 (°C)
+COMPRESSION_MAX_GAP = 60.0      # 默认最大存储间隔 (秒)
+
+def compression_spec(inst):
+    """(方式, 容差, 最大间隔)；未开启压缩返回 None"""
+    mode = inst.get('compression')
+    if mode not in COMPRESSION_MODES: return None
+    try: tol = float(inst.get('tolerance', COMPRESSION_TOLERANCE)); gap = float(inst.get('max_gap', COMPRESSION_MAX_GAP))
+    except (TypeError, ValueError): tol, gap = COMPRESSION_TOLERANCE, COMPRESSION_MAX_GAP
+    return mode, max(0.0, tol), max(inst_interval(inst), gap)
+
+class DeadbandCompressor:
+    """死区压缩：与最后存储值相差不超过容差的点不存储；超出时补存变化前的最后一点。
+    还原误差不超过 2 倍容差 (台阶处两侧各一个容差)。"""
+
+    def __init__(self, tolerance, max_gap):
+        self.tolerance = tolerance; self.max_gap = max_gap
+        self.last = None        # 最后存储的点 (ts, 温度)
+        self.prev = None        # 最近一个被省略的点，需要时补存
+        self.reset()
+
+    def reset(self): pass
+
+    def fits(self, ts, temp):
+        """该点能否由最后存储的点代表 (两者都是有效温度时调用)"""
+        return abs(temp - self.last[1]) <= self.tolerance
+
+    def accepts(self, ts, temp):
+        last = self.last
+        if ts - last[0] > self.max_gap: return False
+        if (temp == INVALID_TEMP) != (last[1] == INVALID_TEMP): return False     # 通讯中断/恢复的边界总要存储
+        return temp == INVALID_TEMP or self.fits(ts, temp)
+
+    def store(self, point):
+        self.last = point; self.prev = None; self.reset()
+        return point
+
+    def held_point(self):
+        """补存被省略的点时实际写入的值"""
+        return self.prev
+
+    def add(self, ts, temp):
+        """返回需要写库的点 [(ts, 温度), ...]"""
+        out = []
+        while self.last is not None:
+            if self.accepts(ts, temp):
+                self.prev = (ts, temp); return out
+            if self.prev is None: break
+            out.append(self.store(self.held_point()))   # 先存上一个点作为新起点，再用它判断当前点
+        out.append(self.store((ts, temp)))
+        return out
+
+    def flush(self):
+        """停止采集时补存最后一个被省略的点"""
+        return [self.store(self.held_point())] if self.prev is not None else []
+
+class SwingingDoorCompressor(DeadbandCompressor):
+    """旋转门压缩：从最后存储点出发，只要仍存在一条直线与其后所有点的偏差都不超过容差就不存储。
+    门打开时存储的是这条直线在上一个点处的值 (而不是实测值)，所以线性插值还原误差不超过容差。
+    对缓慢升降温比死区压缩省得多。"""
+
+    def reset(self):
+        self.slope_lo = -math.inf; self.slope_hi = math.inf
+
+    def fits(self, ts, temp):
+        dt = ts - self.last[0]
+        if dt <= 0: return True
+        lo = max(self.slope_lo, (temp - self.tolerance - self.last[1]) / dt)
+        hi = min(self.slope_hi, (temp + self.tolerance - self.last[1]) / dt)
+        if lo > hi: return False    # 门已打开
+        self.slope_lo, self.slope_hi = lo, hi
+        return True
+
+    def held_point(self):
+        ts, temp = self.prev
+        if temp == INVALID_TEMP or self.last[1] == INVALID_TEMP or ts <= self.last[0]: return self.prev
+        return ts, round(self.last[1] + (self.slope_lo + self.slope_hi) / 2 * (ts - self.last[0]), 2)
+
+def make_compressor(spec):
+    mode, tol, gap = spec
+    return (SwingingDoorCompressor if mode == "swinging_door" else DeadbandCompressor)(tol, gap)
+
+def reconstruct(rows, t_start, t_end, step, max_gap):
+    """把压缩存储的 [(ts, 温度), ...] 还原为 (t_start, t_end] 内对齐到 step 整数倍的等间隔序列。
+    存储点之间线性插值；间隔超过 max_gap 不插值；一端是通讯失败值时沿用左侧的值。
+    rows 应包含 t_start 之前和 t_end 之后最近的存储点。"""
+    if not rows: return []
+    ts = np.array([r[0] for r in rows], dtype=np.float64); v = np.array([r[1] for r in rows], dtype=np.float64)
+    grid = (math.floor(t_start / step) + 1 + np.arange(max(0, int((t_end - t_start) / step) + 1))) * step
+    grid = grid[(grid > t_start) & (grid <= t_end)]
+    i = np.searchsorted(ts, grid, side="right")        # ts[i-1] <= 网格点 < ts[i]
+    il = np.maximum(i - 1, 0); ir = np.minimum(i, len(ts) - 1); has_right = i < len(ts)
+    span = np.where(has_right, ts[ir] - ts[il], grid - ts[il])     # 最后一个存储点之后按保持处理
+    ok = (i > 0) & (span <= max_gap + 1e-6)
+    w = np.where(has_right, (grid - ts[il]) / np.maximum(ts[ir] - ts[il], 1e-9), 0.0)
+    lerp = has_right & (v[il] != INVALID_TEMP) & (v[ir] != INVALID_TEMP)
+    val = np.round(np.where(lerp, v[il] + (v[ir] - v[il]) * w, v[il]), 2)
+    return list(zip(grid[ok].tolist(), val[ok].tolist()))
+
+# ================= 报警 =================
+# 按仪表配置 (均可省略)：alarm_high / alarm_low 上下限 °C，alarm_rate 变化率 °C/分 (在 alarm_rate_window 秒内计算，默认 60)，
+# alarm_stuck 读数持续不变多少秒，alarm_comm 连续多少秒没有有效读数 (默认 30，0 关闭)。
+# 所有通道的状态放在按通道编号的 numpy 数组里：每来一批样本只做一次向量运算，各项统计按样本增量更新，
+# 不回查数据库，单个样本的开销与通道数无关。报警触发和解除各产生一条 AlarmEvent。
+ALARM_KINDS = ("high", "low", "rate", "stuck", "comm")
+ALARM_NAMES = {"high": "超上限", "low": "超下限", "rate": "变化过快", "stuck": "读数不变", "comm": "通讯中断"}
+ALARM_UNITS = {"high": "°C", "low": "°C", "rate": "°C/分", "stuck": "秒", "comm": "秒"}
+ALARM_HYSTERESIS = 0.5      # 上下限回差 (°C)，避免在限值附近反复触发
+ALARM_RATE_WINDOW = 60.0    # 默认变化率窗口 (秒)
+ALARM_RATE_SLOTS = 600      # 变化率窗口最多保留的样本数
+ALARM_COMM_SECONDS = 30.0   # 默认通讯中断判定时间
+STUCK_BAND = 0.05           # 变化小于此值视为读数不变 (仪表分辨率 0.1°C)
+
+AlarmEvent = namedtuple("AlarmEvent", "ts addr kind active value")
+
+def alarm_spec(inst):
+    """(上限, 下限, 变化率, 窗口秒, 卡死秒, 断线秒)，未设置的项为 None"""
+    def num(key, default=None):
+        try: v = inst.get(key, default); return None if v in (None, "") else float(v)
+        except (TypeError, ValueError): return default
+    rate_window = num('alarm_rate_window', ALARM_RATE_WINDOW) or ALARM_RATE_WINDOW
+    stuck = num('alarm_stuck'); comm = num('alarm_comm', ALARM_COMM_SECONDS)
+    return (num('alarm_high'), num('alarm_low'), num('alarm_rate'), rate_window, stuck or None, comm or None)
+
+def alarm_text(event, name=None):
+    kind = ALARM_NAMES[event.kind] + ("" if event.active else " 解除")
+    return f"{name or f'{event.addr}号仪表'} {kind}: {event.value:.1f} {ALARM_UNITS[event.kind]}"
+
+class AlarmEngine:
+    """流式报警判断。feed 由各采集线程调用，check 由调度线程每秒调用 (判断通讯中断)，configure 在配置变化时重建数组"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.specs = None
+        self.addrs = []; self.slot = {}                 # 通道编号 <-> 地址
+        self.active = np.zeros((0, len(ALARM_KINDS)), dtype=bool)
+        self.last_ok = np.zeros(0)
+
+    def configure(self, instruments, now=None):
+        specs = tuple((i['addr'], alarm_spec(i), inst_interval(i)) for i in list(instruments))
+        if specs == self.specs: return
+        now = time.time() if now is None else now
+        nan = lambda v: np.nan if v is None else v
+        n = len(specs)
+        with self.lock:
+            old_active = {a: self.active[k] for a, k in self.slot.items()}; old_ok = {a: self.last_ok[k] for a, k in self.slot.items()}
+            self.specs = specs
+            self.addrs = [a for a, _, _ in specs]; self.slot = {a: k for k, a in enumerate(self.addrs)}
+            cols = np.array([[nan(v) for v in spec] for _, spec, _ in specs]).reshape(n, 6)
+            self.high, self.low, self.rate, window, self.stuck, self.comm = cols.T
+            # 变化率：每通道一个环形缓冲，容量为窗口内的样本数，新样本覆盖的那一格正好是约一个窗口之前的值
+            self.size = np.clip(np.round(window / [iv for _, _, iv in specs]), 1, ALARM_RATE_SLOTS).astype(int) if n else np.zeros(0, dtype=int)
+            self.pos = np.zeros(n, dtype=int)
+            self.hist_t = np.full((n, ALARM_RATE_SLOTS), np.nan); self.hist_v = np.full((n, ALARM_RATE_SLOTS), np.nan)
+            self.ref_v = np.full(n, np.nan); self.ref_t = np.full(n, np.nan)   # 读数不变的起点
+            self.last_ok = np.array([old_ok.get(a, now) for a in self.addrs], dtype=float)
+            self.active = np.array([old_active.get(a, np.zeros(len(ALARM_KINDS), dtype=bool)) for a in self.addrs], dtype=bool).reshape(n, len(ALARM_KINDS))
+
+    def feed(self, samples):
+        """samples: [(时间戳秒, addr, Reading 或 None), ...]，返回状态变化的 AlarmEvent 列表"""
+        with self.lock:
+            # 读取失败以 Reading 为 None 判断，不看数值：热电偶等输入的真实读数可能低于 -100°C
+            rows = [(self.slot[addr], ts, r.pv if r else np.nan, r is not None) for ts, addr, r in samples if addr in self.slot]
+            events = []
+            # 快通道在同一批里可能出现多次，按出现次序分轮，每轮内通道不重复
+            while rows:
+                seen = set(); batch = []; rest = []
+                for row in rows: (rest if row[0] in seen else batch).append(row); seen.add(row[0])
+                idx, ts, val, ok = (np.array(c) for c in zip(*batch))
+                events.extend(self.evaluate(idx, ts, val, ok)); rows = rest
+            return events
+
+    def evaluate(self, idx, ts, val, ok):
+        self.ref_v[idx[~ok]] = np.nan        # 断线期间不累计卡死时间
+        i, t, x = idx[ok], ts[ok], val[ok]
+        if not len(i): return []
+        self.last_ok[i] = t
+        act = self.active[i]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            high = np.where(act[:, 0], x > self.high[i] - ALARM_HYSTERESIS, x > self.high[i])
+            low = np.where(act[:, 1], x < self.low[i] + ALARM_HYSTERESIS, x < self.low[i])
+            pos = (self.pos[i] + 1) % self.size[i]; self.pos[i] = pos
+            rate = (x - self.hist_v[i, pos]) / (t - self.hist_t[i, pos]) * 60.0
+            self.hist_t[i, pos] = t; self.hist_v[i, pos] = x
+            moved = ~(np.abs(x - self.ref_v[i]) <= STUCK_BAND)
+            self.ref_v[i] = np.where(moved, x, self.ref_v[i]); self.ref_t[i] = np.where(moved, t, self.ref_t[i])
+            still = t - self.ref_t[i]
+            cond = np.column_stack([high, low, np.abs(rate) > self.rate[i], still >= self.stuck[i]])
+        return self.transition(i, t, cond, np.column_stack([x, x, rate, still]), [0, 1, 2, 3])
+
+    def check(self, now=None):
+        """没有有效读数超过 alarm_comm 秒判为通讯中断 (含串口打不开、不再产生样本的情况)"""
+        now = time.time() if now is None else now
+        with self.lock:
+            i = np.arange(len(self.addrs)); lost = now - self.last_ok
+            with np.errstate(invalid="ignore"): cond = lost >= self.comm
+            return self.transition(i, np.full(len(i), now), cond[:, None], lost[:, None], [4])
+
+    def transition(self, i, t, cond, value, cols):
+        changed = cond != self.active[np.ix_(i, cols)]
+        if not changed.any(): return []
+        self.active[np.ix_(i, cols)] = cond
+        return [AlarmEvent(float(t[r]), self.addrs[i[r]], ALARM_KINDS[cols[k]], bool(cond[r, k]), float(value[r, k])) for r, k in zip(*np.nonzero(changed))]
+
+    def active_alarms(self):
+        with self.lock: return [(self.addrs[r], ALARM_KINDS[k]) for r, k in zip(*np.nonzero(self.active))]
+
+# ================= 数据存储 =================
+DB_BATCH_INTERVAL = 1.0     # 写线程攒批的最长时间 (秒)
+DB_BATCH_SIZE = 1000        # 攒够这么多行立即写入
+RETENTION_CHECK_SECONDS = 3600  # 过期分区检查周期
+
+ROLLUP_LEVELS = (10, 60, 600)   # 汇总级别 (秒)：每桶记录最小/最大/平均
+SCHEMA_VERSION = 3
+
+def to_db_ts(ts): return int(round(ts * 1000))          # 秒 -> 整数毫秒
+def to_db_temp(t): return int(round(t * 10))            # °C -> 整数 0.1°C
+def day_key(ts): return datetime.fromtimestamp(ts).strftime('%Y%m%d')  # 样本所属的日分区
+
+def day_bounds(day):
+    """日分区 'YYYYMMDD' 的起止时间戳 (本地时间)"""
+    d = datetime.strptime(day, '%Y%m%d')
+    return d.timestamp(), (d + timedelta(days=1)).timestamp()
+
+class Database:
+    """SQLite 存储。
+    所有写操作只走一个写线程：采集线程把样本放进队列，写线程定时用 executemany 整批写入并提交；
+    界面和导出从连接池借独立的读连接，WAL 模式下读写互不阻塞。
+
+    表结构 (user_version=3)：
+      samples_<YYYYMMDD>(address, ts, temp)：按本地日期分区，主键 (address, ts)，WITHOUT ROWID；
+          ts 为整数毫秒，temp 为整数 0.1°C，日期/时间字符串只在导出时生成。
+          过期数据整表 DROP，配合 auto_vacuum=INCREMENTAL 归还空间，不再逐行 DELETE。
+      rollup_<秒>(address, bucket, vmin, vmax, vsum, n)：各级汇总，bucket 为桶起点 (整数秒)，温度单位 0.1°C。
+      alarms(ts, address, kind, active, value)：报警触发/解除记录，ts 为整数毫秒，value 单位见 ALARM_UNITS。
+    指定 archive_dir 时，超出保留期的日分区先写入冷数据归档 (ColdArchive) 再 DROP，查询跨越热/冷两层。"""
+
+    def __init__(self, path, archive_dir=None):
+        self.path = path
+        self.archive = ColdArchive(archive_dir) if archive_dir else None
+        self.queue = queue.Queue()      # 元素: ("samples"/"rollups", 行列表)，或在写连接上执行的函数 fn(conn)
+        self.readers = queue.LifoQueue()
+        self.is_running = True
+        conn = self.connect()
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')     # 只对新建的库生效，旧库在迁移时 VACUUM 切换
+        conn.execute('PRAGMA journal_mode=WAL')
+        for level in ROLLUP_LEVELS:
+            conn.execute(f'''CREATE TABLE IF NOT EXISTS rollup_{level} (address INTEGER NOT NULL, bucket INTEGER NOT NULL,
+                             vmin INTEGER, vmax INTEGER, vsum INTEGER, n INTEGER, PRIMARY KEY (address, bucket)) WITHOUT ROWID''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS alarms (ts INTEGER NOT NULL, address INTEGER NOT NULL, kind TEXT NOT NULL, active INTEGER, value REAL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS alarms_ts ON alarms (ts)")
+        conn.commit()
+        self.load_partitions(conn)
+        self.migration_report = self.migrate(conn)
+        conn.close()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    # --- 表结构升级 ---
+    def has_table(self, conn, name):
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone() is not None
+
+    def migrate(self, conn):
+        """按 user_version 逐级升级；旧版 records 表迁移时返回文件大小与查询速度的对比报告"""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION: return None
+        legacy = version < 1 and self.has_table(conn, "records")
+        if legacy:
+            size0 = self.file_size(conn)
+            t_end = conn.execute("SELECT MAX(timestamp) FROM records").fetchone()[0] or time.time()
+            t0 = time.perf_counter()
+            conn.execute("SELECT timestamp, address, temperature FROM records WHERE timestamp > ? ORDER BY timestamp ASC", (t_end - 3600,)).fetchall()
+            q0 = time.perf_counter() - t0
+            # v1: REAL 时间戳 + 日期/时间字符串 -> 整数毫秒/0.1°C 的 samples 表
+            conn.execute('''CREATE TABLE IF NOT EXISTS samples (address INTEGER NOT NULL, ts INTEGER NOT NULL, temp INTEGER,
+                            PRIMARY KEY (address, ts)) WITHOUT ROWID''')
+            conn.execute("INSERT OR IGNORE INTO samples SELECT address, CAST(ROUND(timestamp * 1000) AS INTEGER), CAST(ROUND(temperature * 10) AS INTEGER) FROM records")
+            conn.execute("DROP TABLE records")
+        if self.has_table(conn, "samples"):
+            # v2: 从已有样本一次性生成汇总表，之后由写线程增量维护
+            if version < 2:
+                for level in ROLLUP_LEVELS:
+                    conn.execute(f"""INSERT OR REPLACE INTO rollup_{level} SELECT address, (ts / {level * 1000}) * {level}, MIN(temp), MAX(temp), SUM(temp), COUNT(*)
+                                     FROM samples WHERE temp != {to_db_temp(INVALID_TEMP)} GROUP BY address, ts / {level * 1000}""")
+            # v3: 单表拆成日分区
+            lo, hi = conn.execute("SELECT MIN(ts), MAX(ts) FROM samples").fetchone()
+            if lo is not None:
+                day = day_key(lo / 1000.0)
+                while day <= day_key(hi / 1000.0):
+                    a, b = day_bounds(day)
+                    self.create_partition(conn, day)
+                    conn.execute(f"INSERT OR REPLACE INTO samples_{day} SELECT address, ts, temp FROM samples WHERE ts >= ? AND ts < ?", (to_db_ts(a), to_db_ts(b)))
+                    day = day_key(b)
+            conn.execute("DROP TABLE samples")
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        conn.commit()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL"); conn.execute("VACUUM")
+        if not legacy: return None
+        size1 = self.file_size(conn)
+        addrs = self.addresses(t_end - 3600, t_end)
+        t0 = time.perf_counter()
+        for addr in addrs: self.fetch(addr, t_end - 3600, t_end)
+        q1 = time.perf_counter() - t0
+        report = f"数据库已迁移到紧凑格式：文件 {size0 / 1e6:.1f}MB -> {size1 / 1e6:.1f}MB，最近1小时查询 {q0 * 1000:.0f}ms -> {q1 * 1000:.0f}ms"
+        log.info(report)
+        return report
+
+    def file_size(self, conn):
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return os.path.getsize(self.path)
+
+    # --- 日分区 ---
+    def load_partitions(self, conn):
+        names = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'samples\\_%' ESCAPE '\\'")]
+        self.partition_days = tuple(sorted(n[len("samples_"):] for n in names))
+
+    def create_partition(self, conn, day):
+        conn.execute(f'''CREATE TABLE IF NOT EXISTS samples_{day} (address INTEGER NOT NULL, ts INTEGER NOT NULL, temp INTEGER,
+                         PRIMARY KEY (address, ts)) WITHOUT ROWID''')
+        if day not in self.partition_days: self.partition_days = tuple(sorted(self.partition_days + (day,)))
+
+    def partitions_between(self, t_start, t_end):
+        d0, d1 = day_key(t_start), day_key(t_end)
+        return [d for d in self.partition_days if d0 <= d <= d1]
+
+    # --- 读写 ---
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextmanager
+    def reader(self):
+        """借一个读连接，用完归还"""
+        try: conn = self.readers.get_nowait()
+        except queue.Empty: conn = self.connect()
+        try: yield conn
+        finally: self.readers.put(conn)
+
+    def put(self, rows):
+        """rows: [(ts 秒, addr, 温度), ...]"""
+        self.queue.put(("samples", rows))
+
+    def put_rollups(self, rows):
+        """rows: [(级别, addr, 桶起点, 最小, 最大, 总和, 个数), ...]，与库中同一桶的已有值合并"""
+        self.queue.put(("rollups", rows))
+
+    def put_alarms(self, events):
+        rows = [(to_db_ts(e.ts), e.addr, e.kind, int(e.active), e.value) for e in events]
+        self.submit(lambda conn: conn.executemany("INSERT INTO alarms VALUES (?, ?, ?, ?, ?)", rows))
+
+    def submit(self, fn):
+        """在写线程里执行 fn(conn)，用于删除过期数据等维护操作"""
+        self.queue.put(fn)
+
+    def write_loop(self):
+        conn = self.connect()
+        pending = {"samples": [], "rollups": []}; deadline = None
+        while self.is_running or deadline is not None or not self.queue.empty():
+            wait = DB_BATCH_INTERVAL if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=wait)
+                if callable(item):
+                    self.flush(conn, pending); deadline = None
+                    try: item(conn); conn.commit()
+                    except:
+                        conn.rollback(); metrics.inc("yudian_db_errors_total"); log.exception("数据库维护/写入任务失败")
+                    continue
+                pending[item[0]].extend(item[1])
+                if deadline is None: deadline = time.monotonic() + DB_BATCH_INTERVAL
+            except queue.Empty: pass
+            if deadline is not None and (len(pending["samples"]) >= DB_BATCH_SIZE or time.monotonic() >= deadline or not self.is_running):
+                self.flush(conn, pending); deadline = None
+        conn.close()
+
+    def flush(self, conn, pending):
+        if not pending["samples"] and not pending["rollups"]: return
+        t0 = time.monotonic()
+        try:
+            by_day = {}
+            for ts, addr, temp in pending["samples"]:
+                by_day.setdefault(day_key(ts), []).append((addr, to_db_ts(ts), to_db_temp(temp)))
+            for day, rows in by_day.items():
+                if day not in self.partition_days: self.create_partition(conn, day)
+                conn.executemany(f"INSERT OR REPLACE INTO samples_{day} VALUES (?, ?, ?)", rows)
+            for level in ROLLUP_LEVELS:
+                rows = [(addr, bucket, to_db_temp(vmin), to_db_temp(vmax), to_db_temp(vsum), n)
+                        for lv, addr, bucket, vmin, vmax, vsum, n in pending["rollups"] if lv == level]
+                if rows: conn.executemany(f"""INSERT INTO rollup_{level} VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (address, bucket) DO UPDATE SET
+                                              vmin=MIN(vmin, excluded.vmin), vmax=MAX(vmax, excluded.vmax), vsum=vsum+excluded.vsum, n=n+excluded.n""", rows)
+            conn.commit()
+            metrics.observe("yudian_db_commit_seconds", time.monotonic() - t0); metrics.inc("yudian_db_rows_total", len(pending["samples"]))
+        except:
+            conn.rollback(); metrics.inc("yudian_db_errors_total"); log.exception("写入数据库失败")
+        pending["samples"] = []; pending["rollups"] = []
+
+    def cleanup_old_data(self):
+        """整日分区超出保留期就 (归档后) 直接 DROP，再增量回收空闲页；汇总表很小，按桶删除，边界与分区对齐"""
+        t = day_bounds(day_key((datetime.now() - timedelta(days=DATA_RETENTION_DAYS)).timestamp()))[0]
+        def job(conn):
+            for day in [d for d in self.partition_days if d < day_key(t)]:
+                if self.archive is not None:
+                    try: self.archive_partition(conn, day)
+                    except:
+                        log.exception("归档 %s 失败，下次再试", day); return
+                conn.execute(f"DROP TABLE IF EXISTS samples_{day}")
+                self.partition_days = tuple(d for d in self.partition_days if d != day)
+            for level in ROLLUP_LEVELS: conn.execute(f"DELETE FROM rollup_{level} WHERE bucket < ?", (int(t),))
+            conn.execute("DELETE FROM alarms WHERE ts < ?", (to_db_ts(t),))
+            conn.commit()
+            # execute() 只执行一步，每次只回收一页；executescript 执行到底，空闲页全部归还
+            conn.executescript("PRAGMA incremental_vacuum;")
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if free: log.warning("增量回收后仍有 %d 个空闲页", free)
+        self.submit(job)
+
+    def archive_partition(self, conn, day):
+        """逐个地址读出一个日分区写入归档，内存中只有一个地址一天的数据"""
+        table = f"samples_{day}"
+        addrs = [r[0] for r in conn.execute(f"""WITH RECURSIVE a(x) AS (SELECT MIN(address) FROM {table}
+                 UNION ALL SELECT (SELECT MIN(address) FROM {table} WHERE address > x) FROM a WHERE x IS NOT NULL)
+                 SELECT x FROM a WHERE x IS NOT NULL""")]
+        for addr in addrs:
+            rows = np.array(conn.execute(f"SELECT ts, temp FROM {table} WHERE address=? ORDER BY ts", (addr,)).fetchall(), dtype=np.int64).reshape(-1, 2)
+            self.archive.write_day(day, {addr: (rows[:, 0], rows[:, 1])})
+        log.info("%s 已归档: %d 个地址", day, len(addrs))
+
+    def cold_days(self, t_start, t_end):
+        """时间段内只在归档里的日期 (同一天还有热分区时以热分区为准)"""
+        if self.archive is None: return []
+        d0, d1 = day_key(t_start), day_key(t_end); hot = set(self.partition_days)
+        return [d for d in self.archive.days() if d0 <= d <= d1 and d not in hot]
+
+    def oldest(self):
+        """最早有数据的日期起点 (含归档)，没有数据返回 None"""
+        days = list(self.partition_days) + (self.archive.days() if self.archive is not None else [])
+        return day_bounds(min(days))[0] if days else None
+
+    def fetch_arrays(self, addr, t_start, t_end=None):
+        """与 fetch 相同，但返回 (ts 秒数组, 温度数组)；归档部分直接切片内存映射，长时间范围用这个"""
+        t_end = t_end if t_end is not None else time.time() + 86400
+        ts, temp = self.archive.fetch(addr, self.cold_days(t_start, t_end), to_db_ts(t_start), to_db_ts(t_end)) if self.archive is not None else (np.zeros(0, np.int64),) * 2
+        rows = self.fetch_hot(addr, t_start, t_end)
+        hot = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        return np.concatenate([ts / 1000.0, hot[:, 0]]), np.concatenate([temp / 10.0, hot[:, 1]])
+
+    def fetch(self, addr, t_start, t_end=None, resample=None):
+        """单个地址在 (t_start, t_end] 内的数据，跨日分区 (和归档) 按时间升序拼接 [(ts 秒, 温度), ...]。
+        resample=(采样周期, 最大间隔) 表示该通道是压缩存储的，返回还原后的等间隔序列"""
+        if resample is not None:
+            step, gap = resample; t_end = t_end if t_end is not None else time.time()
+            return reconstruct(self.fetch(addr, t_start - gap, t_end + gap), t_start, t_end, step, gap)
+        t_end = t_end if t_end is not None else time.time() + 86400
+        if not self.cold_days(t_start, t_end): return self.fetch_hot(addr, t_start, t_end)
+        ts, temp = self.fetch_arrays(addr, t_start, t_end)
+        return list(zip(ts.tolist(), temp.tolist()))
+
+    def fetch_hot(self, addr, t_start, t_end):
+        rows = []
+        with self.reader() as conn:
+            for day in self.partitions_between(t_start, t_end):
+                try:
+                    rows.extend(conn.execute(f"SELECT ts / 1000.0, temp / 10.0 FROM samples_{day} WHERE address=? AND ts > ? AND ts <= ? ORDER BY ts",
+                                             (addr, to_db_ts(t_start), to_db_ts(t_end))).fetchall())
+                except sqlite3.OperationalError: pass   # 分区刚被保留期清理删除
+        return rows
+
+    def fetch_rollup(self, addr, level, t_start, t_end=None):
+        """某级汇总中桶起点在 (t_start, t_end] 内的数据 [(桶起点, 最小, 最大, 平均), ...]。
+        归档日期没有汇总表，从归档的原始数据现算"""
+        t_end = t_end if t_end is not None else time.time() + 86400
+        cold = []
+        if self.cold_days(t_start, t_end):
+            ts, temp = self.archive.fetch(addr, self.cold_days(t_start, t_end + level), to_db_ts(t_start), to_db_ts(t_end + level))
+            cold = [r for r in rollup_rows(ts, temp, level) if t_start < r[0] <= t_end]
+        with self.reader() as conn:
+            return cold + conn.execute(f"SELECT bucket, vmin / 10.0, vmax / 10.0, vsum / 10.0 / n FROM rollup_{level} WHERE address=? AND bucket > ? AND bucket <= ? ORDER BY bucket",
+                                (addr, int(t_start), int(t_end))).fetchall()
+
+    def fetch_alarms(self, t_start, t_end=None):
+        """(t_start, t_end] 内的报警记录，按时间倒序 [AlarmEvent, ...]"""
+        t_end = t_end if t_end is not None else time.time() + 86400
+        with self.reader() as conn:
+            rows = conn.execute("SELECT ts / 1000.0, address, kind, active, value FROM alarms WHERE ts > ? AND ts <= ? ORDER BY ts DESC",
+                                (to_db_ts(t_start), to_db_ts(t_end))).fetchall()
+        return [AlarmEvent(ts, addr, kind, bool(active), value) for ts, addr, kind, active, value in rows]
+
+    def addresses(self, t_start, t_end):
+        """时间段内有数据的地址 (沿主键跳跃查找，不扫全表)"""
+        found = set(self.archive.addresses(self.cold_days(t_start, t_end), to_db_ts(t_start), to_db_ts(t_end))) if self.archive is not None else set()
+        with self.reader() as conn:
+            for day in self.partitions_between(t_start, t_end):
+                table = f"samples_{day}"
+                try:
+                    addrs = [r[0] for r in conn.execute(f"""WITH RECURSIVE a(x) AS (SELECT MIN(address) FROM {table}
+                             UNION ALL SELECT (SELECT MIN(address) FROM {table} WHERE address > x) FROM a WHERE x IS NOT NULL)
+                             SELECT x FROM a WHERE x IS NOT NULL""")]
+                    found.update(a for a in addrs if a not in found and conn.execute(f"SELECT 1 FROM {table} WHERE address=? AND ts > ? AND ts <= ? LIMIT 1",
+                                                                                      (a, to_db_ts(t_start), to_db_ts(t_end))).fetchone())
+                except sqlite3.OperationalError: pass
+        return sorted(found)
+
+    def close(self):
+        """写完队列中剩余的数据后关闭"""
+        self.is_running = False
+        self.writer.join(timeout=10)
+        while not self.readers.empty(): self.readers.get_nowait().close()
+
+# ================= 冷数据归档 =================
+# 超出保留期的日分区按 日期/地址 拆成列式文件：<目录>/<YYYYMMDD>/<地址>.ts.npy (int64 毫秒) 和 .temp.npy (int16 0.1°C)，
+# 与库中的整数格式一致。读取时以内存映射方式打开，按时间二分查找后只切片需要的部分，不会读入其它地址或其它日期。
+def rollup_rows(ts, temp, level):
+    """由原始数据 (整数毫秒, 整数 0.1°C) 计算某级汇总 [(桶起点, 最小, 最大, 平均), ...]，与汇总表规则相同 (不含通讯失败点)"""
+    ok = temp != to_db_temp(INVALID_TEMP)
+    ts, temp = ts[ok], temp[ok].astype(np.int64)
+    if not len(ts): return []
+    bucket = ts // (level * 1000) * level
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    n = np.diff(np.r_[starts, len(ts)])
+    vmin = np.minimum.reduceat(temp, starts); vmax = np.maximum.reduceat(temp, starts); vsum = np.add.reduceat(temp, starts)
+    return list(zip(bucket[starts].tolist(), (vmin / 10.0).tolist(), (vmax / 10.0).tolist(), (vsum / 10.0 / n).tolist()))
+
+class ColdArchive:
+    """按 日期/地址 存放的列式归档。写入只在数据库写线程里进行，读取可在任意线程"""
 
-class App:
     def __init__(self, root):
+        self.root = root                # 第一次归档时才创建
+        self.day_list = None
+
+    def days(self):
+        if self.day_list is None:
+            try: self.day_list = sorted(d for d in os.listdir(self.root) if len(d) == 8 and d.isdigit())
+            except OSError: self.day_list = []
+        return self.day_list
+
+    def path(self, day, addr, col): return os.path.join(self.root, day, f"{addr}.{col}.npy")
+
+    def write_day(self, day, columns):
+        """columns: {addr: (ts 毫秒数组, 温度 0.1°C 数组)}，已有的同日文件合并去重。先写临时文件再改名，中途断电不会留下半个文件"""
+        os.makedirs(os.path.join(self.root, day), exist_ok=True)
+        for addr, (ts, temp) in columns.items():
+            old_ts, old_temp = (np.array(c) for c in self.load(day, addr))  # 复制出来，不占着即将被替换的映射文件
+            if len(old_ts):
+                ts, idx = np.unique(np.concatenate([ts, old_ts]), return_index=True)     # 相同时刻以新数据为准
+                temp = np.concatenate([temp, old_temp])[idx]
+            for col, arr in (("ts", np.asarray(ts, dtype=np.int64)), ("temp", np.asarray(temp, dtype=np.int16))):
+                path = self.path(day, addr, col)
+                with open(path + ".tmp", "wb") as f: np.save(f, arr)
+                os.replace(path + ".tmp", path)
+        self.day_list = None
+
+    def load(self, day, addr):
+        """内存映射打开一个地址一天的数据；没有归档返回空数组"""
+        try:
+            ts = np.load(self.path(day, addr, "ts"), mmap_mode="r"); temp = np.load(self.path(day, addr, "temp"), mmap_mode="r")
+        except (OSError, ValueError): return np.zeros(0, np.int64), np.zeros(0, np.int16)
+        if len(ts) != len(temp): return np.zeros(0, np.int64), np.zeros(0, np.int16)
+        return ts, temp
+
+    def fetch(self, addr, days, ts_start, ts_end):
+        """days 中 ts 在 (ts_start, ts_end] 毫秒内的数据 (ts 数组, 温度数组)，仍为整数格式"""
+        parts = []
+        for day in days:
+            ts, temp = self.load(day, addr)
+            i, j = np.searchsorted(ts, ts_start, side="right"), np.searchsorted(ts, ts_end, side="right")
+            if j > i: parts.append((ts[i:j], temp[i:j]))
+        if not parts: return np.zeros(0, np.int64), np.zeros(0, np.int16)
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    def addresses(self, days, ts_start, ts_end):
+        found = set()
+        for day in days:
+            try: names = os.listdir(os.path.join(self.root, day))
+            except OSError: continue
+            for name in names:
+                if not name.endswith(".ts.npy"): continue
+                try: addr = int(name.split(".")[0])
+                except ValueError: continue
+                if addr not in found and len(self.fetch(addr, [day], ts_start, ts_end)[0]): found.add(addr)
+        return sorted(found)
+
+# ================= 内存缓冲 =================
+MAX_PLOT_HOURS = 24 * DATA_RETENTION_DAYS       # 绘图范围上限
+RAW_PLOT_SECONDS = MAX_PLOT_POINTS * ROLLUP_LEVELS[0]   # 更长的绘图范围改用汇总数据，原始缓冲只需覆盖这么久
+
+class RingBuffer:
+    """单通道环形缓冲：时间戳和数值存放在定长 NumPy 数组中，追加 O(1)。
+    采集线程直接追加，界面按时间区间取数据，不必每秒查询数据库。ncols>1 时每个时间点存一行多列。"""
+
+    def __init__(self, capacity, ncols=1):
+        self.capacity = capacity
+        self.ts = np.zeros(capacity, dtype=np.float64)
+        self.val = np.zeros(capacity if ncols == 1 else (capacity, ncols), dtype=np.float32)
+        self.head = 0               # 下一次写入位置
+        self.size = 0
+        self.count = 0              # 累计写入次数，界面据此判断数据是否有变化
+        self.lock = threading.Lock()
+
+    def append(self, ts, val):
+        with self.lock:
+            self.ts[self.head] = ts; self.val[self.head] = val
+            self.head = (self.head + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+            self.count += 1
+
+    def extend(self, ts, val):
+        """批量追加 (预热用)，ts 须按时间升序"""
+        ts = np.asarray(ts, dtype=np.float64)[-self.capacity:]; val = np.asarray(val, dtype=np.float32)[-self.capacity:]
+        with self.lock:
+            n = len(ts); first = min(n, self.capacity - self.head)
+            self.ts[self.head:self.head + first] = ts[:first]; self.val[self.head:self.head + first] = val[:first]
+            self.ts[:n - first] = ts[first:]; self.val[:n - first] = val[first:]
+            self.head = (self.head + n) % self.capacity
+            self.size = min(self.size + n, self.capacity)
+            self.count += n
+
+    def _segments(self):
+        """按时间顺序排列的 (起, 止) 下标段"""
+        start = (self.head - self.size) % self.capacity
+        if start + self.size <= self.capacity: return [(start, start + self.size)]
+        return [(start, self.capacity), (0, self.head)]
+
+    def since(self, t_start):
+        """时间戳 > t_start 的数据，返回 (ts, val) 数组副本"""
+        with self.lock:
+            parts = []
+            for a, b in self._segments():
+                i = a + int(np.searchsorted(self.ts[a:b], t_start, side="right"))
+                if i < b: parts.append((self.ts[i:b].copy(), self.val[i:b].copy()))
+        if not parts: return np.empty(0), np.empty((0,) + self.val.shape[1:], dtype=np.float32)
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    def tail(self, seen, limit):
+        """累计计数 seen 之后新追加的数据 (最多 limit 条，时间升序)，返回 (当前计数, ts, val)"""
+        with self.lock:
+            n = max(0, min(self.count - seen, self.size, limit))
+            idx = (self.head - n + np.arange(n)) % self.capacity
+            return self.count, self.ts[idx], self.val[idx]
+
+def rollup_capacity(level):
+    """某级汇总在内存中保留的桶数：只需覆盖会选用该级别的最长绘图范围"""
+    coarser = [lv for lv in ROLLUP_LEVELS if lv > level]
+    span = min(MAX_PLOT_HOURS * 3600, coarser[0] * MAX_PLOT_POINTS) if coarser else MAX_PLOT_HOURS * 3600
+    return int(span // level) + 1
+
+def pick_rollup_level(window_sec, points=MAX_PLOT_POINTS):
+    """能给出不少于 points 个点的最粗汇总级别；窗口太短则返回 None (用原始数据)"""
+    for level in reversed(ROLLUP_LEVELS):
+        if window_sec / level >= points: return level
+    return None
+
+def minmax_decimate(ts, vmin, vmax, n_buckets):
+    """压缩到 n_buckets 个桶，每桶保留最小值和最大值 (尖峰不会被抽稀掉)，返回交替排列的 (x, y)"""
+    if len(ts) > n_buckets:
+        idx = np.unique(np.linspace(0, len(ts), n_buckets, endpoint=False).astype(int))
+        ts, vmin, vmax = ts[idx], np.minimum.reduceat(vmin, idx), np.maximum.reduceat(vmax, idx)
+    return np.repeat(ts, 2), np.column_stack([vmin, vmax]).ravel()
+
+class ChannelRollup:
+    """单通道多级汇总 (每桶最小/最大/平均)，随样本到达增量维护。
+    桶结束时写入内存缓冲 (供绘图) 并返回给调用者写库；通讯失败的样本不计入。"""
+
+    def __init__(self):
+        self.acc = {level: None for level in ROLLUP_LEVELS}     # 当前未结束的桶 [起点, 最小, 最大, 总和, 个数]
+        self.buffers = {level: RingBuffer(rollup_capacity(level), 3) for level in ROLLUP_LEVELS}   # 列: 最小, 最大, 平均
+
+    def add(self, ts, temp):
+        """返回刚结束的桶 [(级别, 起点, 最小, 最大, 总和, 个数), ...]"""
+        if temp == INVALID_TEMP: return []
+        closed = []
+        for level, acc in self.acc.items():
+            bucket = int(ts // level) * level
+            if acc is not None and acc[0] != bucket:
+                closed.append((level,) + tuple(acc)); self.push(level, acc)
+                acc = None
+            if acc is None: self.acc[level] = [bucket, temp, temp, temp, 1]
+            else: acc[1] = min(acc[1], temp); acc[2] = max(acc[2], temp); acc[3] += temp; acc[4] += 1
+        return closed
+
+    def push(self, level, acc):
+        self.buffers[level].append(acc[0] + level / 2, (acc[1], acc[2], acc[3] / acc[4]))
+
+    def pending(self):
+        """尚未结束的桶，退出时写库 (与下次启动后的同一桶合并)"""
+        return [(level,) + tuple(acc) for level, acc in self.acc.items() if acc is not None]
+
+# ================= 历史浏览 =================
+TILE_BUCKETS = 1000         # 每块覆盖的桶数：原始数据每块 1000 秒，汇总数据每块 1000 个桶
+TILE_CACHE_SIZE = 256       # 缓存的块数 (LRU)
+MIN_VIEW_SECONDS = 60       # 最多放大到 1 分钟
+
+def tile_seconds(level): return TILE_BUCKETS * (level or 1)
+
+def settle_seconds(inst):
+    """一段时间结束后，该仪表的数据最迟多久才全部进库：汇总桶要等下一个样本才写出，压缩通道最多压着 max_gap 秒的点"""
+    spec = compression_spec(inst)
+    return inst_interval(inst) + (spec[2] if spec else 0.0)
+
+class TileCache:
+    """历史浏览的分块数据缓存。按 (地址, 级别, 块号) 从数据库读取 (级别 None 为原始数据)，
+    已经结束的块放进 LRU 缓存，来回平移/缩放时不再查询 SQLite；包含当前时刻的块仍在增长，每次重新读取。"""
+
+    def __init__(self, db, size=TILE_CACHE_SIZE):
+        self.db = db; self.size = size
+        self.tiles = OrderedDict()      # (addr, level, 块号) -> (ts, 最小, 最大)
+
+    def load(self, addr, level, idx):
+        span = tile_seconds(level); a = idx * span
+        if level is None:
+            ts, v = self.db.fetch_arrays(addr, a, a + span); v = v.astype(np.float32)
+            return ts, v, v
+        # 桶起点都是 level 的整数倍，(a - level, a + span - level] 即 [a, a + span)
+        rows = self.db.fetch_rollup(addr, level, a - level, a + span - level)
+        return (np.array([r[0] + level / 2 for r in rows], dtype=np.float64),
+                np.array([r[1] for r in rows], dtype=np.float32), np.array([r[2] for r in rows], dtype=np.float32))
+
+    def get(self, addr, level, t_start, t_end, settle=0.0):
+        """[t_start, t_end] 所在各块拼接后的 (ts, 最小, 最大)，只截取该时间段。
+        settle 见 settle_seconds，块结束后过了这么久才算完整、可以缓存"""
+        span = tile_seconds(level); complete_before = time.time() - (level or 0) - settle - 2 * DB_BATCH_INTERVAL
+        parts = []
+        for idx in range(int(t_start // span), int(t_end // span) + 1):
+            key = (addr, level, idx)
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key); metrics.inc("yudian_tile_requests_total", result="hit")
+            else:
+                tile = self.load(addr, level, idx); metrics.inc("yudian_tile_requests_total", result="miss")
+                if (idx + 1) * span <= complete_before:
+                    self.tiles[key] = tile
+                    if len(self.tiles) > self.size: self.tiles.popitem(last=False)
+            parts.append(tile)
+        ts, vmin, vmax = (np.concatenate(c) for c in zip(*parts))
+        i, j = np.searchsorted(ts, t_start), np.searchsorted(ts, t_end, side="right")
+        return ts[i:j], vmin[i:j], vmax[i:j]
+
+# ================= 数据导出 =================
+EXPORT_CHUNK_SECONDS = 3600     # 每次从数据库读取并写出的时间段长度
+
+class Exporter(threading.Thread):
+    """后台导出线程：按时间顺序分段读取、逐段转成宽表并立即写出，内存占用与导出范围长短无关。
+    按文件扩展名选择格式：.csv / .csv.gz / .parquet (需要 pyarrow)。"""
+
+    def __init__(self, db, path, columns, t_start, t_end, step=1.0, resample=None):
+        super().__init__(daemon=True)
+        self.db = db; self.path = path
+        self.columns = columns          # [(addr, 列名), ...]
+        self.resample = resample or {}  # 压缩存储的通道 addr -> (采样周期, 最大间隔)，导出时还原
+        self.step = step                # 合并为一行的时间粒度 (秒)，有亚秒采样的仪表时小于 1，时间列带毫秒
+        self.t_start = t_start; self.t_end = t_end
+        self.progress = 0.0
+        self.rows_written = 0
+        self.error = None
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def chunks(self):
+        """逐段产出 [(日期, 时间, 温度...), ...]，同一时间粒度内的多路数据合为一行"""
+        a = self.t_start
+        while a < self.t_end and not self.cancel_event.is_set():
+            b = min(a + EXPORT_CHUNK_SECONDS, self.t_end)
+            rows = {}
+            for i, (addr, _) in enumerate(self.columns):
+                for ts, temp in self.db.fetch(addr, a, b, self.resample.get(addr)):
+                    rows.setdefault(int(ts // self.step), [None] * len(self.columns))[i] = temp
+            out = []
+            for key in sorted(rows):
+                d = datetime.fromtimestamp(key * self.step)
+                t = d.strftime('%H:%M:%S') + (f".{d.microsecond // 1000:03d}" if self.step < 1 else "")
+                out.append((d.strftime('%Y-%m-%d'), t) + tuple(rows[key]))
+            yield out
+            a = b; self.progress = (a - self.t_start) / (self.t_end - self.t_start)
+
+    def run(self):
+        header = ["date_str", "time_str"] + [name for _, name in self.columns]
+        try:
+            if self.path.lower().endswith(".parquet"): self.write_parquet(header)
+            else: self.write_csv(header)
+        except Exception as e:
+            self.error = e
+        if self.error is not None or self.cancel_event.is_set():
+            try: os.remove(self.path)
+            except OSError: pass
+
+    def write_csv(self, header):
+        if self.path.lower().endswith(".gz"): f = gzip.open(self.path, "wt", encoding="utf-8-sig", newline="")
+        else: f = open(self.path, "w", encoding="utf-8-sig", newline="")
+        with f:
+            w = csv.writer(f); w.writerow(header)
+            for rows in self.chunks():
+                w.writerows(rows); self.rows_written += len(rows)
+
+    def write_parquet(self, header):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([(h, pa.string()) for h in header[:2]] + [(h, pa.float64()) for h in header[2:]])
+        with pq.ParquetWriter(self.path, schema, compression="snappy") as writer:
+            for rows in self.chunks():
+                if not rows: continue
+                writer.write_table(pa.Table.from_arrays([pa.array(c) for c in zip(*rows)], schema=schema))
+                self.rows_written += len(rows)
+
+# ================= 实时数据发布 =================
+# 本机 TCP 服务 (默认 127.0.0.1:9109，--pubsub-port 0 关闭)：其它程序订阅实时数据，不必去查数据库，也不必占用串口。
+# 客户端发送文本命令 (每行一条)：SUB 1,2,3 / SUB * 订阅，UNSUB 2 / UNSUB * 取消。
+# 服务端发送二进制帧：2 字节小端长度 + 负载。负载第一个字节是类型：
+#   1 样本  <BBHdffbB  类型, 标志 (bit0=读取成功), 地址, 时间戳秒, PV, SV, MV, 报警状态
+#   2 丢帧  <BI        类型, 因客户端读得太慢而丢弃的帧数 (丢弃的是最旧的帧)
+PUBSUB_PORT = 9109
+PUBSUB_QUEUE_FRAMES = 2000      # 每个客户端最多积压的帧数
+FRAME_SAMPLE = 1
+FRAME_DROPPED = 2
+FRAME_HEADER = struct.Struct("<H")
+SAMPLE_PAYLOAD = struct.Struct("<BBHdffbB")
+DROPPED_PAYLOAD = struct.Struct("<BI")
+
+def encode_frame(payload): return FRAME_HEADER.pack(len(payload)) + payload
+
+def encode_sample(ts, addr, reading):
+    if reading is None: return encode_frame(SAMPLE_PAYLOAD.pack(FRAME_SAMPLE, 0, addr, ts, INVALID_TEMP, math.nan, 0, 0))
+    return encode_frame(SAMPLE_PAYLOAD.pack(FRAME_SAMPLE, 1, addr, ts, reading.pv, reading.sv, reading.mv, reading.alarm))
+
+class Subscriber:
+    """一个已连接的订阅者：订阅的地址集合和待发送的帧 (有上限，满了丢最旧的)"""
+
+    def __init__(self, sock, max_frames):
+        self.sock = sock; self.max_frames = max_frames
+        self.addrs = set(); self.all = False
+        self.frames = deque(); self.dropped = 0
+        self.inbuf = b""; self.out = b""
+
+    def wants(self, addr): return self.all or addr in self.addrs
+
+    def push(self, frame):
+        if len(self.frames) >= self.max_frames:
+            self.frames.popleft(); self.dropped += 1; metrics.inc("yudian_pubsub_frames_total", result="dropped")
+        self.frames.append(frame)
+
+    def command(self, line):
+        parts = line.strip().split(None, 1)
+        if len(parts) != 2 or parts[0].upper() not in ("SUB", "UNSUB"): return
+        sub = parts[0].upper() == "SUB"
+        if parts[1].strip() == "*":
+            self.all = sub
+            if not sub: self.addrs.clear()
+            return
+        try: addrs = {int(a) for a in parts[1].split(",") if a.strip()}
+        except ValueError: return
+        if sub: self.addrs |= addrs
+        else: self.addrs -= addrs
+
+class PubSubServer(threading.Thread):
+    """单线程 selectors 事件循环：接受连接、读订阅命令、把积压的帧尽量写出。
+    publish 由采集线程调用，只把帧放进各订阅者的有界队列，不会被慢客户端阻塞。"""
+
+    def __init__(self, port=PUBSUB_PORT, host="127.0.0.1", max_frames=PUBSUB_QUEUE_FRAMES):
+        super().__init__(daemon=True)
+        self.max_frames = max_frames
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port)); self.listener.listen(16); self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        self.wake_r, self.wake_w = socket.socketpair()     # 有新数据时唤醒事件循环
+        self.wake_r.setblocking(False); self.wake_w.setblocking(False)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.listener, selectors.EVENT_READ)
+        self.sel.register(self.wake_r, selectors.EVENT_READ)
+        self.clients = {}       # socket -> Subscriber
+        self.lock = threading.Lock()
+        self.is_running = True
+
+    def publish(self, samples):
+        """samples: [(时间戳秒, addr, Reading 或 None), ...]"""
+        with self.lock:
+            if not self.clients: return
+            frames = [(addr, encode_sample(ts, addr, r)) for ts, addr, r in samples]
+            for c in self.clients.values():
+                for addr, frame in frames:
+                    if c.wants(addr): c.push(frame)
+        self.wake()
+
+    def wake(self):
+        try: self.wake_w.send(b"\0")
+        except OSError: pass    # 缓冲区满说明事件循环已被唤醒
+
+    def stop(self):
+        self.is_running = False; self.wake()
+
+    def drop(self, sock):
+        with self.lock: self.clients.pop(sock, None)
+        try: self.sel.unregister(sock)
+        except (KeyError, ValueError): pass
+        sock.close()
+
+    def run(self):
+        while self.is_running:
+            for key, events in self.sel.select(timeout=1.0):
+                sock = key.fileobj
+                if sock is self.listener:
+                    try: conn, _ = self.listener.accept()
+                    except OSError: continue
+                    conn.setblocking(False)
+                    with self.lock: self.clients[conn] = Subscriber(conn, self.max_frames)
+                    self.sel.register(conn, selectors.EVENT_READ)
+                    metrics.inc("yudian_pubsub_connections_total")
+                elif sock is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096): pass
+                    except OSError: pass
+                else:
+                    c = self.clients.get(sock)
+                    if c is None: continue
+                    if events & selectors.EVENT_READ and not self.read_commands(c): self.drop(sock); continue
+                    if events & selectors.EVENT_WRITE and not self.send_pending(c): self.drop(sock); continue
+            # 有待发送数据的连接关注可写事件，没有的只关注可读
+            for sock, c in list(self.clients.items()):
+                want = selectors.EVENT_READ | (selectors.EVENT_WRITE if c.out or c.frames or c.dropped else 0)
+                try:
+                    if self.sel.get_key(sock).events != want: self.sel.modify(sock, want)
+                except (KeyError, ValueError): pass
+        for sock in list(self.clients): self.drop(sock)
+        self.sel.close(); self.listener.close(); self.wake_r.close(); self.wake_w.close()
+
+    def read_commands(self, c):
+        try: data = c.sock.recv(4096)
+        except BlockingIOError: return True
+        except OSError: return False
+        if not data: return False
+        c.inbuf += data
+        *lines, c.inbuf = c.inbuf.split(b"\n")
+        with self.lock:
+            for line in lines: c.command(line.decode("ascii", "ignore"))
+        if len(c.inbuf) > 4096: return False        # 不是本协议的客户端
+        return True
+
+    def send_pending(self, c):
+        # 上一批写完才从队列取下一批，积压量始终受 max_frames 限制
+        if not c.out:
+            with self.lock:
+                parts = []
+                if c.dropped: parts.append(encode_frame(DROPPED_PAYLOAD.pack(FRAME_DROPPED, c.dropped))); c.dropped = 0
+                parts.extend(c.frames); n = len(c.frames); c.frames.clear()
+            c.out = b"".join(parts)
+            if n: metrics.inc("yudian_pubsub_frames_total", n, result="sent")
+        try: sent = c.sock.send(c.out)
+        except BlockingIOError: return True
+        except OSError: return False
+        c.out = c.out[sent:]
+        return True
+
+def start_pubsub_server(port):
+    """端口被占用时记日志后继续采集"""
+    try: server = PubSubServer(port)
+    except OSError as e:
+        log.warning("实时发布端口 %d 不可用: %s", port, e); return None
+    server.start()
+    log.info("实时数据发布: tcp://127.0.0.1:%d", server.port)
+    return server
+
+class PubSubClient:
+    """实时数据订阅客户端，供其它脚本使用：
+        for ts, addr, reading in PubSubClient([1, 2]): ...
+    reading 为 None 表示该次读取失败；dropped 为服务端因读得太慢而丢弃的累计帧数。"""
+
+    def __init__(self, addrs=None, host="127.0.0.1", port=PUBSUB_PORT, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.buf = b""; self.dropped = 0
+        self.subscribe(addrs)
+
+    def subscribe(self, addrs=None, sub=True):
+        target = "*" if addrs is None else ",".join(str(a) for a in addrs)
+        self.sock.sendall(f"{'SUB' if sub else 'UNSUB'} {target}\n".encode("ascii"))
+
+    def __iter__(self):
+        while True:
+            while len(self.buf) >= FRAME_HEADER.size:
+                (n,) = FRAME_HEADER.unpack_from(self.buf)
+                if len(self.buf) < FRAME_HEADER.size + n: break
+                payload = self.buf[FRAME_HEADER.size:FRAME_HEADER.size + n]; self.buf = self.buf[FRAME_HEADER.size + n:]
+                if payload[0] == FRAME_SAMPLE:
+                    _, flags, addr, ts, pv, sv, mv, alarm = SAMPLE_PAYLOAD.unpack(payload)
+                    yield ts, addr, (Reading(round(pv, 1), round(sv, 1), mv, alarm) if flags & 1 else None)
+                elif payload[0] == FRAME_DROPPED:
+                    self.dropped += DROPPED_PAYLOAD.unpack(payload)[1]
+            data = self.sock.recv(65536)
+            if not data: return
+            self.buf += data
+
+    def close(self): self.sock.close()
+
+# ================= 采集服务 =================
+def load_config(path=CONFIG_FILE):
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except: pass
+    return [{"name": "1号仪表", "addr": 1, "color": "#ff0000"}]
+
+def check_instruments(instruments):
+    """地址是缓冲、汇总、数据库里的通道键，不同总线上也不能重复 (否则两台仪表会混进同一通道)。
+    保留每个地址第一次出现的仪表，返回 (可用的仪表, 提示信息或 None)"""
+    kept = []; seen = {}; dropped = []
+    for inst in instruments:
+        addr = inst.get('addr')
+        if addr in seen:
+            dropped.append(f"{inst.get('name', '')} (地址 {addr}, 串口 {inst.get('port') or '默认'}) 与 {seen[addr]} 地址重复")
+            continue
+        seen[addr] = inst.get('name', ''); kept.append(inst)
+    if not dropped: return kept, None
+    report = ("以下仪表已忽略，请在配置文件中改为不重复的地址 (在界面中保存仪表配置会把它们从配置文件中去掉)：\n" + "\n".join(dropped))
+    log.error(report)
+    return kept, report
+
+def save_config(instruments, path=CONFIG_FILE):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(instruments, f, ensure_ascii=False, indent=2)
+
+class Service:
+    """采集核心 (串口轮询 + 缓冲 + 存储)，不依赖任何界面库。
+    可以单独以 --headless 运行做无人值守记录，Tk 界面只是读取它的缓冲和数据库的客户端。"""
+
+    def __init__(self, instruments, default_port="", default_protocol="AIBUS", db_path=DB_FILE, config_path=CONFIG_FILE, metrics_port=METRICS_PORT, pubsub_port=PUBSUB_PORT, archive_dir=None):
+        self.instruments, self.config_report = check_instruments(instruments)
+        self.config_path = config_path
+        self.default_port = default_port            # 仪表没有单独指定 port 时使用
+        self.default_protocol = default_protocol
+        self.is_running = True
+        self.workers = {}   # 端口 -> BusWorker
+        self.buffers = {}   # 地址 -> RingBuffer (最近的原始数据)
+        self.rollups = {}   # 地址 -> ChannelRollup
+        self.compressors = {}   # 地址 -> (压缩参数, 压缩器)，仅开启压缩的仪表
+        self.comp_lock = threading.Lock()   # 压缩器由各总线线程使用，更换/收尾时不能同时 add
+        # 归档目录默认与数据库同名加 _archive，传空字符串则过期数据直接删除
+        self.db = Database(db_path, archive_dir if archive_dir is not None else os.path.splitext(db_path)[0] + "_archive")
+        self.metrics_port = metrics_port; self.metrics_server = None
+        self.pubsub_port = pubsub_port; self.pubsub = None
+        self.alarms = AlarmEngine()
+        self.alarm_listeners = []   # 报警状态变化时调用 fn(events)，界面用来弹托盘通知
+
+    def save_config(self):
+        save_config(self.instruments, self.config_path)
+
+    def start(self):
+        if self.metrics_port: self.metrics_server = start_metrics_server(self.metrics_port)
+        if self.pubsub_port: self.pubsub = start_pubsub_server(self.pubsub_port)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """停止采集：等调度线程和各总线线程退出 (退出前会交出手里的样本)，
+        再写入压缩器和汇总中未结束的部分，等写线程落盘后关闭数据库"""
+        self.is_running = False
+        if getattr(self, "thread", None) is not None: self.thread.join(timeout=WORKER_JOIN_TIMEOUT)   # 之后不会再新建总线线程
+        workers = list(self.workers.values())
+        for w in workers: w.stop()
+        for w in workers:
+            w.join(timeout=WORKER_JOIN_TIMEOUT)
+            if w.is_alive(): log.warning("%s 采集线程未能及时停止，之后的样本不再保存", w.port)
+        with self.comp_lock:
+            self.db.put([(ts, addr, temp) for addr, (_, c) in self.compressors.items() for ts, temp in c.flush()])
+        self.db.put_rollups([(c[0], addr) + c[1:] for addr, r in self.rollups.items() for c in r.pending()])
+        self.db.close()
+        if self.metrics_server is not None: self.metrics_server.shutdown()
+        if self.pubsub is not None: self.pubsub.stop()
+
+    def inst_port(self, inst):
+        """仪表所在串口：配置里写了 port 就用它，否则用默认端口"""
+        return inst.get('port') or self.default_port
+
+    def port_jobs(self, port):
+        return [(i['addr'], i.get('protocol') or self.default_protocol, inst_interval(i)) for i in list(self.instruments) if self.inst_port(i) == port]
+
+    def save_samples(self, samples):
+        """各总线线程攒一批样本后调用：先发布给实时订阅者，再交给写线程批量写入"""
+        if self.pubsub is not None: self.pubsub.publish(samples)
+        rows = [(ts, addr, r.pv if r else INVALID_TEMP) for ts, addr, r in samples]
+        closed = []; stored = []
+        for ts, addr, temp in rows:
+            buf = self.buffers.get(addr)
+            if buf is not None: buf.append(ts, temp)
+            rollup = self.rollups.get(addr)
+            if rollup is not None: closed.extend((c[0], addr) + c[1:] for c in rollup.add(ts, temp))
+        with self.comp_lock:
+            for ts, addr, temp in rows:
+                comp = self.compressors.get(addr)
+                if comp is None: stored.append((ts, addr, temp))
+                else: stored.extend((t, addr, v) for t, v in comp[1].add(ts, temp))
+        if len(stored) < len(rows): metrics.inc("yudian_compressed_samples_total", len(rows) - len(stored))
+        if stored: self.db.put(stored)
+        if closed: self.db.put_rollups(closed)
+        self.dispatch_alarms(self.alarms.feed(samples))
+
+    def dispatch_alarms(self, events):
+        """记日志、写库并通知监听者"""
+        if not events: return
+        names = {i['addr']: i['name'] for i in list(self.instruments)}
+        for e in events:
+            (log.warning if e.active else log.info)("报警 %s", alarm_text(e, names.get(e.addr)))
+            if e.active: metrics.inc("yudian_alarms_total", kind=e.kind, addr=e.addr)
+        self.db.put_alarms(events)
+        for fn in list(self.alarm_listeners):
+            try: fn(events)
+            except: log.exception("报警通知失败")
+
+    def ensure_buffers(self):
+        """为新出现的地址建立原始/汇总缓冲，并从数据库预热 (仅冷启动/新增仪表/改采样周期时读库)。
+        原始缓冲按采样周期定容量，始终覆盖 RAW_PLOT_SECONDS。压缩设置变化时更换压缩器。"""
+        for inst in list(self.instruments):
+            addr = inst['addr']
+            spec = compression_spec(inst); comp = self.compressors.get(addr)
+            if (comp[0] if comp else None) != spec:
+                with self.comp_lock:
+                    if comp: self.db.put([(ts, addr, temp) for ts, temp in comp[1].flush()])
+                    if spec: self.compressors[addr] = (spec, make_compressor(spec))
+                    else: self.compressors.pop(addr, None)
+            capacity = int(RAW_PLOT_SECONDS / inst_interval(inst)) + 1
+            if addr in self.buffers and self.buffers[addr].capacity == capacity: continue
+            now_ts = time.time()
+            buf = RingBuffer(capacity)
+            rows = self.db.fetch(addr, now_ts - RAW_PLOT_SECONDS, resample=self.resample_spec(inst))
+            if rows: buf.extend(*zip(*rows))
+            if addr in self.rollups:
+                self.buffers[addr] = buf; continue
+            rollup = ChannelRollup()
+            for level, rbuf in rollup.buffers.items():
+                rows = self.db.fetch_rollup(addr, level, now_ts - rbuf.capacity * level)
+                if rows: rbuf.extend([r[0] + level / 2 for r in rows], [r[1:] for r in rows])
+            self.rollups[addr] = rollup
+            self.buffers[addr] = buf
+
+    def resample_spec(self, inst):
+        """压缩存储的仪表读库时按 (采样周期, 最大间隔) 还原，其它返回 None"""
+        spec = compression_spec(inst)
+        return (inst_interval(inst), spec[2]) if spec else None
+
+    def run(self):
+        """调度线程：按端口分组仪表，每个端口一个 BusWorker，多条总线同时轮询；并定期清理过期分区"""
+        next_cleanup = 0.0
+        while self.is_running:
+            if time.monotonic() >= next_cleanup:
+                self.db.cleanup_old_data(); next_cleanup = time.monotonic() + RETENTION_CHECK_SECONDS
+            self.ensure_buffers()
+            self.alarms.configure([i for i in list(self.instruments) if self.inst_port(i)])     # 没有串口的仪表不轮询，也不判断断线
+            self.dispatch_alarms(self.alarms.check())
+            ports = set(self.inst_port(i) for i in list(self.instruments)) - {""}
+            for port in ports - set(self.workers):
+                w = BusWorker(port, lambda p=port: self.port_jobs(p), self.save_samples)
+                self.workers[port] = w; w.start()
+            for port in set(self.workers) - ports:
+                self.workers.pop(port).stop()
+            time.sleep(1)
+        for w in self.workers.values(): w.stop()
+
+UI_PART_NAMES = {"tree": "表格", "plot": "曲线", "history": "历史浏览"}     # yudian_ui_render_seconds 的 part 标签
+
+class App:
+    def __init__(self, root, service):
         self.root = root
+        self.service = service
         self.root.title("AI-708 实验室温控系统 (后台运行版)")
         self.root.state('zoomed') 
 
@@ -54,12 +1695,15 @@ class App:
 
         # --- 变量初始化 ---
         self.is_running = True
-        self.serial_conn = None 
         self.selected_port = tk.StringVar()
-        self.protocol_type = tk.StringVar(value="AIBUS") # 默认AIBUS
+        self.protocol_type = tk.StringVar(value=service.default_protocol) # 默认AIBUS
+        # 采集线程只读服务对象的普通属性，不直接碰 Tk 变量
+        self.selected_port.trace_add("write", lambda *a: setattr(service, "default_port", self.selected_port.get()))
+        self.protocol_type.trace_add("write", lambda *a: setattr(service, "default_protocol", self.protocol_type.get()))
         
-        # 加载仪表配置
-        self.instruments = self.load_config() 
+        # 仪表配置与数据库由采集服务持有
+        self.instruments = service.instruments
+        self.db = service.db
 
         # 导出相关变量
         self.export_mode = tk.StringVar(value="recent") 
@@ -69,13 +1713,10 @@ class App:
         self.start_time_str = tk.StringVar(value=past_str)
         self.end_time_str = tk.StringVar(value=now_str)
 
+        self.exporter = None
         self.plot_duration_val = tk.StringVar(value="60") 
         self.plot_duration_unit = tk.StringVar(value="分钟") 
 
-        # 数据库
-        self.init_db()
-        self.cleanup_old_data()
-
         # ================= 菜单栏 =================
         self.create_menu()
 
@@ -108,10 +1749,12 @@ class App:
         # 2.1 绘图区
         graph_frame = tk.Frame(left_frame)
         graph_frame.pack(side="top", fill="both", expand=True)
-        self.fig, self.ax = plt.subplots()
-        self.fig.subplots_adjust(bottom=0.15, left=0.08, right=0.95, top=0.90) 
-        self.canvas = FigureCanvasTkAgg(self.fig, master=graph_frame)
-        self.canvas.get_tk_widget().pack(fill="both", expand=True)
+        # matplotlib 导入较慢，窗口先显示出来，再在 init_plot 中创建画布
+        self.graph_frame = graph_frame; self.canvas = None
+        self.lines = {}; self.plot_key = None; self.plot_version = None; self.plot_background = None
+        # 历史浏览：history_view 为 (起, 止) 时间戳时冻结实时刷新，按可见范围从 TileCache 取数据
+        self.history_view = None; self.history_drag = None; self.history_pending = False
+        self.tiles = TileCache(self.db)
 
         # 2.2 控制与导出区
         ctrl_frame = tk.LabelFrame(left_frame, text="数据导出与设置", font=("微软雅黑", 30, "bold"), bg="white")
@@ -124,6 +1767,8 @@ class App:
         v_cmd = (root.register(self.validate_number), '%P')
         tk.Entry(ctrl_frame, textvariable=self.plot_duration_val, font=font_entry, width=4, validate="key", validatecommand=v_cmd).grid(row=0, column=1, sticky="w")
         ttk.Combobox(ctrl_frame, textvariable=self.plot_duration_unit, values=["分钟", "小时"], font=("微软雅黑", 22), width=4, state="readonly").grid(row=0, column=2, sticky="w", padx=5)
+        self.btn_history = tk.Button(ctrl_frame, text="历史浏览", font=("微软雅黑", 20), command=self.toggle_history)
+        self.btn_history.grid(row=0, column=3, sticky="w", padx=20)
         
         # 导出模式
         ttk.Radiobutton(ctrl_frame, text="模式1: 最近", variable=self.export_mode, value="recent", style="Big.TRadiobutton").grid(row=1, column=0, sticky="w", padx=10)
@@ -163,20 +1808,28 @@ class App:
         self.setup_tree_columns()
 
         # ================= 启动 =================
+        # refresh_ports 选中第一个端口时会经 trace 覆盖 default_port，先记下命令行指定的端口
+        cli_port = service.default_port
         self.refresh_ports()
+        if cli_port: self.selected_port.set(cli_port)
         
         # 启动托盘图标线程
+        self.icon = None
         threading.Thread(target=self.init_tray_icon, daemon=True).start()
+        service.alarm_listeners.append(self.notify_alarms)
 
-        # 启动数据线程
-        self.thread = threading.Thread(target=self.data_loop, daemon=True)
-        self.thread.start()
+        # 启动采集服务
+        service.start()
         
+        self.root.after(0, self.init_plot)
         self.root.after(1000, self.update_ui)
+        if self.db.migration_report: self.root.after(500, lambda: messagebox.showinfo("数据库升级", self.db.migration_report))
+        if service.config_report: self.root.after(600, lambda: messagebox.showwarning("仪表配置", service.config_report))
 
     # ================= 托盘与后台运行逻辑 =================
     def create_image(self):
         """生成一个简单的图标 (避免依赖外部ico文件)"""
+        from PIL import Image, ImageDraw
         width = 64
         height = 64
         color1 = "blue"
@@ -189,6 +1842,8 @@ class App:
 
     def init_tray_icon(self):
         """初始化托盘图标"""
+        import pystray
+        from pystray import MenuItem as item
         image = self.create_image()
         menu = (item('显示窗口', self.show_window), item('退出系统', self.quit_app))
         self.icon = pystray.Icon("name", image, "实验室温控系统", menu)
@@ -202,6 +1857,14 @@ class App:
             self.icon.notify("软件仍在后台运行记录数据", "已最小化到托盘")
         except: pass
 
+    def notify_alarms(self, events):
+        """采集线程回调：新触发的报警用托盘气泡提示"""
+        names = {i['addr']: i['name'] for i in list(self.instruments)}
+        text = "\n".join(alarm_text(e, names.get(e.addr)) for e in events if e.active)
+        if not text or self.icon is None: return
+        try: self.icon.notify(text, "温度报警")
+        except: pass
+
     def show_window(self):
         """从托盘恢复窗口"""
         self.root.deiconify()
@@ -212,98 +1875,10 @@ class App:
         self.is_running = False
         if self.icon:
             self.icon.stop()
-        self.conn.close()
+        self.service.stop()
         self.root.quit()
-        import sys
         sys.exit(0)
 
-    # ================= 核心通讯函数 =================
-    def open_serial(self, port):
-        """根据协议打开串口"""
-        try:
-            if self.serial_conn is not None:
-                if self.serial_conn.port == port and self.serial_conn.is_open:
-                    return True 
-                else:
-                    self.serial_conn.close()
-            
-            baud = 9600 
-            
-            self.serial_conn = serial.Serial(
-                port=port,
-                baudrate=baud, 
-                bytesize=8,
-                parity=serial.PARITY_NONE,
-                stopbits=1,
-                timeout=0.2 
-            )
-            self.lbl_status.config(text=f"串口已开: {port} ({self.protocol_type.get()})", fg="green")
-            return True
-        except Exception as e:
-            self.lbl_status.config(text=f"串口错误: {e}", fg="red")
-            self.serial_conn = None
-            return False
-
-    def read_temp(self, addr):
-        proto = self.protocol_type.get()
-        if proto == "AIBUS":
-            return self.read_aibus_temp(addr)
-        else:
-            return self.read_modbus_temp(addr)
-
-    def read_aibus_temp(self, addr):
-        if self.serial_conn is None: return -100.0
-        try:
-            chk = 0x52 + addr 
-            chk_low = chk & 0xFF
-            chk_high = (chk >> 8) & 0xFF
-            header_byte = 0x80 + addr
-            cmd = bytes([header_byte, header_byte, 0x52, 0x00, 0x00, 0x00, chk_low, chk_high])
-            self.serial_conn.flushInput()
-            self.serial_conn.write(cmd)
-            resp = self.serial_conn.read(10)
-            if len(resp) < 10: return -100.0 
-            pv_raw = resp[0] + (resp[1] << 8)
-            if pv_raw > 32767: pv_raw -= 65536
-            return pv_raw / 10.0
-        except: return -100.0
-
-    def read_modbus_temp(self, addr):
-        if self.serial_conn is None: return -100.0
-        try:
-            def calc_crc(data):
-                crc = 0xFFFF
-                for pos in data:
-                    crc ^= pos
-                    for i in range(8):
-                        if (crc & 1) != 0: crc >>= 1; crc ^= 0xA001
-                        else: crc >>= 1
-                return crc
-            base_cmd = bytes([addr, 0x03, 0x00, 0x00, 0x00, 0x04])
-            crc = calc_crc(base_cmd)
-            cmd = base_cmd + bytes([crc & 0xFF, (crc >> 8) & 0xFF])
-            self.serial_conn.flushInput()
-            self.serial_conn.write(cmd)
-            resp = self.serial_conn.read(13) 
-            if len(resp) < 13: return -100.0
-            pv_raw = (resp[3] << 8) + resp[4]
-            if pv_raw > 32767: pv_raw -= 65536
-            return pv_raw / 10.0
-        except: return -100.0
-
-    # ================= 配置相关功能 =================
-    def load_config(self):
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except: pass
-        return [{"name": "1号仪表", "addr": 1, "color": "#ff0000"}]
-
-    def save_config(self):
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.instruments, f, ensure_ascii=False, indent=2)
-
     def create_menu(self):
         menubar = tk.Menu(self.root)
         config_menu = tk.Menu(menubar, tearoff=0)
@@ -316,20 +1891,25 @@ class App:
 
         help_menu = tk.Menu(menubar, tearoff=0)
         help_menu.add_command(label="帮我", command=self.show_help)
+        help_menu.add_command(label="诊断信息", command=self.open_diagnostics_window)
+        help_menu.add_command(label="报警记录", command=self.open_alarm_window)
         help_menu.add_command(label="关于", command=self.show_about)
         menubar.add_cascade(label="帮助", menu=help_menu)
 
         self.root.config(menu=menubar)
 
     def open_settings_window(self):
-        win = tk.Toplevel(self.root); win.title("仪表参数配置"); win.geometry("1000x700") 
+        win = tk.Toplevel(self.root); win.title("仪表参数配置"); win.geometry("1100x1250") 
         FONT_UI = ("微软雅黑", 18); FONT_INPUT = ("Arial", 18)
         list_frame = tk.Frame(win, padx=20, pady=20); list_frame.pack(side="left", fill="y")
         tk.Label(list_frame, text="仪表列表", font=("微软雅黑", 18, "bold")).pack()
         lb = tk.Listbox(list_frame, font=FONT_INPUT, width=25, height=20, selectmode=tk.SINGLE, exportselection=False)
         lb.pack(fill="y", expand=True, pady=10)
         edit_frame = tk.Frame(win, padx=40, pady=40); edit_frame.pack(side="left", fill="both", expand=True)
-        name_var = tk.StringVar(); addr_var = tk.StringVar(); color_var = tk.StringVar(value="#ff0000")
+        name_var = tk.StringVar(); addr_var = tk.StringVar(); color_var = tk.StringVar(value="#ff0000"); port_var = tk.StringVar(); interval_var = tk.StringVar()
+        comp_names = {"": "不压缩", "deadband": "死区", "swinging_door": "旋转门"}
+        comp_var = tk.StringVar(value=comp_names[""]); tol_var = tk.StringVar(); gap_var = tk.StringVar()
+        alarm_vars = {k: tk.StringVar() for k in ("alarm_high", "alarm_low", "alarm_rate", "alarm_stuck", "alarm_comm")}
         
         tk.Label(edit_frame, text="仪表名称:", font=FONT_UI).grid(row=0, column=0, pady=15, sticky="e")
         tk.Entry(edit_frame, textvariable=name_var, font=FONT_INPUT, width=20).grid(row=0, column=1, sticky="w", padx=10)
@@ -338,45 +1918,149 @@ class App:
         tk.Label(edit_frame, text="绘图颜色:", font=FONT_UI).grid(row=2, column=0, pady=15, sticky="e")
         color_btn = tk.Button(edit_frame, text="■ 点击选择颜色", font=FONT_UI, bg=color_var.get(), width=15, command=lambda: self.pick_color(color_var, color_btn))
         color_btn.grid(row=2, column=1, sticky="w", padx=10)
+        tk.Label(edit_frame, text="串口 (空=默认):", font=FONT_UI).grid(row=3, column=0, pady=15, sticky="e")
+        tk.Entry(edit_frame, textvariable=port_var, font=FONT_INPUT, width=10).grid(row=3, column=1, sticky="w", padx=10)
+        tk.Label(edit_frame, text=f"采样周期秒 (空={POLL_INTERVAL:g}):", font=FONT_UI).grid(row=4, column=0, pady=15, sticky="e")
+        tk.Entry(edit_frame, textvariable=interval_var, font=FONT_INPUT, width=10).grid(row=4, column=1, sticky="w", padx=10)
+        tk.Label(edit_frame, text="存储压缩:", font=FONT_UI).grid(row=5, column=0, pady=15, sticky="e")
+        ttk.Combobox(edit_frame, textvariable=comp_var, values=list(comp_names.values()), font=FONT_UI, width=8, state="readonly").grid(row=5, column=1, sticky="w", padx=10)
+        tk.Label(edit_frame, text=f"容差°C (空={COMPRESSION_TOLERANCE:g}):", font=FONT_UI).grid(row=6, column=0, pady=15, sticky="e")
+        tk.Entry(edit_frame, textvariable=tol_var, font=FONT_INPUT, width=10).grid(row=6, column=1, sticky="w", padx=10)
+        tk.Label(edit_frame, text=f"最大间隔秒 (空={COMPRESSION_MAX_GAP:g}):", font=FONT_UI).grid(row=7, column=0, pady=15, sticky="e")
+        tk.Entry(edit_frame, textvariable=gap_var, font=FONT_INPUT, width=10).grid(row=7, column=1, sticky="w", padx=10)
+        for row, (key, text) in enumerate((("alarm_high", "报警上限°C (空=无):"), ("alarm_low", "报警下限°C (空=无):"), ("alarm_rate", "变化率报警°C/分 (空=无):"),
+                                            ("alarm_stuck", "读数不变报警秒 (空=无):"), ("alarm_comm", f"断线报警秒 (空={ALARM_COMM_SECONDS:g}, 0=无):")), 8):
+            tk.Label(edit_frame, text=text, font=FONT_UI).grid(row=row, column=0, pady=15, sticky="e")
+            tk.Entry(edit_frame, textvariable=alarm_vars[key], font=FONT_INPUT, width=10).grid(row=row, column=1, sticky="w", padx=10)
 
         def refresh_list(select_idx=None):
             lb.delete(0, tk.END)
-            for inst in self.instruments: lb.insert(tk.END, f"[{inst['addr']}] {inst['name']}")
+            for inst in self.instruments: lb.insert(tk.END, f"[{inst['addr']}] {inst['name']}" + (f" @{inst['port']}" if inst.get('port') else "") + (f" {inst['interval']:g}s" if inst.get('interval') else ""))
             if select_idx is not None and select_idx < lb.size(): lb.selection_set(select_idx); lb.activate(select_idx)
         def on_select(evt):
             if not lb.curselection(): return
             idx = lb.curselection()[0]; data = self.instruments[idx]
-            name_var.set(data['name']); addr_var.set(str(data['addr'])); color_var.set(data['color']); color_btn.config(bg=data['color'])
+            name_var.set(data['name']); addr_var.set(str(data['addr'])); color_var.set(data['color']); color_btn.config(bg=data['color']); port_var.set(data.get('port', "")); interval_var.set(str(data.get('interval', "")))
+            comp_var.set(comp_names.get(data.get('compression', ""), comp_names[""])); tol_var.set(str(data.get('tolerance', ""))); gap_var.set(str(data.get('max_gap', "")))
+            for key, var in alarm_vars.items(): var.set(str(data.get(key, "")))
         lb.bind('<<ListboxSelect>>', on_select)
         
+        def make_inst(base, skip_idx=None):
+            # 地址是数据库里的通道键，不同总线上的仪表也不能重复
+            addr_val = int(addr_var.get().strip())
+            if any(i['addr'] == addr_val for k, i in enumerate(self.instruments) if k != skip_idx): raise ValueError
+            inst = dict(base, name=name_var.get(), addr=addr_val, color=color_var.get())
+            port = port_var.get().strip()
+            if port: inst['port'] = port
+            else: inst.pop('port', None)
+            interval = interval_var.get().strip()
+            if interval:
+                inst['interval'] = float(interval)
+                if inst['interval'] < MIN_INTERVAL: raise ValueError
+            else: inst.pop('interval', None)
+            mode = {v: k for k, v in comp_names.items()}[comp_var.get()]
+            for key, var in (("tolerance", tol_var), ("max_gap", gap_var)):
+                val = var.get().strip()
+                if mode and val:
+                    inst[key] = float(val)
+                    if inst[key] < 0: raise ValueError
+                else: inst.pop(key, None)
+            if mode: inst['compression'] = mode
+            else: inst.pop('compression', None)
+            for key, var in alarm_vars.items():
+                val = var.get().strip()
+                if val: inst[key] = float(val)
+                else: inst.pop(key, None)
+            if inst.get('alarm_rate', 0) < 0 or inst.get('alarm_stuck', 0) < 0 or inst.get('alarm_comm', 0) < 0: raise ValueError
+            return inst
         def add_inst():
             try:
-                addr_val = int(addr_var.get().strip())
-                self.instruments.append({"name": name_var.get(), "addr": addr_val, "color": color_var.get()})
-                self.save_config(); refresh_list(len(self.instruments)-1); self.setup_tree_columns(); messagebox.showinfo("成功", "已添加")
-            except ValueError: messagebox.showerror("错误", "地址错误")
+                self.instruments.append(make_inst({}))
+                self.service.save_config(); refresh_list(len(self.instruments)-1); self.setup_tree_columns(); messagebox.showinfo("成功", "已添加")
+            except ValueError: messagebox.showerror("错误", f"地址错误或重复，采样周期小于 {MIN_INTERVAL} 秒，或压缩/报警参数不是数字")
         def update_inst():
             if not lb.curselection(): return
             idx = lb.curselection()[0]
             try:
-                self.instruments[idx] = {"name": name_var.get(), "addr": int(addr_var.get().strip()), "color": color_var.get()}
-                self.save_config(); refresh_list(idx); self.setup_tree_columns(); messagebox.showinfo("成功", "已保存")
-            except ValueError: messagebox.showerror("错误", "地址错误")
+                self.instruments[idx] = make_inst(self.instruments[idx], idx)
+                self.service.save_config(); refresh_list(idx); self.setup_tree_columns(); messagebox.showinfo("成功", "已保存")
+            except ValueError: messagebox.showerror("错误", f"地址错误或重复，采样周期小于 {MIN_INTERVAL} 秒，或压缩/报警参数不是数字")
         def del_inst():
             if not lb.curselection(): return
-            if messagebox.askyesno("确认", "删除?"): del self.instruments[lb.curselection()[0]]; self.save_config(); refresh_list(); self.setup_tree_columns()
+            if messagebox.askyesno("确认", "删除?"): del self.instruments[lb.curselection()[0]]; self.service.save_config(); refresh_list(); self.setup_tree_columns()
 
         refresh_list()
-        btn_frame = tk.Frame(edit_frame, pady=50); btn_frame.grid(row=3, column=0, columnspan=2)
+        btn_frame = tk.Frame(edit_frame, pady=50); btn_frame.grid(row=13, column=0, columnspan=2)
         tk.Button(btn_frame, text="新增", command=add_inst, font=("微软雅黑", 16), bg="#aaf", width=8).pack(side="left", padx=15)
         tk.Button(btn_frame, text="修改保存", command=update_inst, font=("微软雅黑", 16), bg="#afa", width=10).pack(side="left", padx=15)
         tk.Button(btn_frame, text="删除", command=del_inst, font=("微软雅黑", 16), bg="#faa", width=8).pack(side="left", padx=15)
 
+    def open_diagnostics_window(self):
+        """各仪表通讯质量、各总线轮询耗时、数据库和界面耗时，每秒刷新"""
+        win = tk.Toplevel(self.root); win.title("诊断信息"); win.geometry("1600x900")
+        cols = ("串口", "地址", "成功", "平均ms", "P95ms", "最大ms", "超时", "短帧", "校验错", "其他错误", "退避跳过", "错过周期")
+        tree = ttk.Treeview(win, columns=cols, show="headings", height=10)
+        for c in cols: tree.heading(c, text=c); tree.column(c, width=130, anchor="center")
+        tree.pack(fill="both", expand=True, padx=20, pady=10)
+        summary = tk.Label(win, font=("微软雅黑", 16), justify="left", anchor="w"); summary.pack(fill="x", padx=20, pady=10)
+        ms = lambda v: f"{v * 1000:.1f}"
+        def refresh():
+            if not win.winfo_exists(): return
+            rows = {}
+            for labels, h in metrics.series("yudian_read_seconds"):
+                rows.setdefault((labels["port"], labels["addr"]), {})["h"] = h
+            for labels, v in metrics.series("yudian_read_errors_total"):
+                rows.setdefault((labels["port"], labels["addr"]), {})[labels["kind"]] = v
+            for labels, v in metrics.series("yudian_read_skipped_total"):
+                rows.setdefault((labels["port"], labels["addr"]), {})["skipped"] = v
+            for labels, v in metrics.series("yudian_missed_samples_total"):
+                rows.setdefault((labels["port"], labels["addr"]), {})["missed"] = v
+            tree.delete(*tree.get_children())
+            for (port, addr), r in sorted(rows.items()):
+                h = r.get("h") or Histogram()
+                tree.insert("", "end", values=(port, addr, h.count, ms(h.mean()), ms(h.quantile(0.95)), ms(h.max), r.get("timeout", 0), r.get("short_read", 0),
+                                               r.get("checksum", 0), r.get("protocol", 0) + r.get("serial", 0), r.get("skipped", 0), r.get("missed", 0)))
+            busy = {l["port"]: v for l, v in metrics.series("yudian_bus_busy_seconds_total")}
+            lines = [f"总线 {l['port']}: 调度延迟平均 {ms(h.mean())} ms, P95 {ms(h.quantile(0.95))} ms, 最长 {ms(h.max)} ms, 累计占用 {busy.get(l['port'], 0):.0f} 秒"
+                     for l, h in sorted(metrics.series("yudian_schedule_lag_seconds"), key=lambda x: x[0]["port"])]
+            for l, h in metrics.series("yudian_db_commit_seconds"):
+                lines.append(f"数据库提交: {h.count} 次, 平均 {ms(h.mean())} ms, P95 {ms(h.quantile(0.95))} ms, 最长 {ms(h.max)} ms")
+            for l, h in sorted(metrics.series("yudian_ui_render_seconds"), key=lambda x: x[0]["part"]):
+                lines.append(f"界面刷新 ({UI_PART_NAMES.get(l['part'], l['part'])}): 平均 {ms(h.mean())} ms, 最长 {ms(h.max)} ms")
+            if self.service.metrics_server is not None: lines.append(f"Prometheus: http://127.0.0.1:{self.service.metrics_port}/metrics")
+            summary.config(text="\n".join(lines))
+            win.after(1000, refresh)
+        refresh()
+
+    def open_alarm_window(self):
+        """当前报警和保留期内的报警记录，每 5 秒刷新"""
+        win = tk.Toplevel(self.root); win.title("报警记录"); win.geometry("1200x800")
+        current = tk.Label(win, font=("微软雅黑", 16, "bold"), fg="red", justify="left", anchor="w"); current.pack(fill="x", padx=20, pady=10)
+        cols = ("时间", "仪表", "报警", "状态", "数值")
+        tree = ttk.Treeview(win, columns=cols, show="headings")
+        for c in cols: tree.heading(c, text=c); tree.column(c, width=220, anchor="center")
+        tree.pack(fill="both", expand=True, padx=20, pady=10)
+        def refresh():
+            if not win.winfo_exists(): return
+            names = {i['addr']: i['name'] for i in self.instruments}
+            active = [f"{names.get(a, a)} {ALARM_NAMES[k]}" for a, k in self.service.alarms.active_alarms()]
+            current.config(text="当前报警: " + ("、".join(active) if active else "无"))
+            tree.delete(*tree.get_children())
+            for e in self.db.fetch_alarms(time.time() - DATA_RETENTION_DAYS * 86400)[:1000]:
+                tree.insert("", "end", values=(datetime.fromtimestamp(e.ts).strftime('%m-%d %H:%M:%S'), names.get(e.addr, e.addr), ALARM_NAMES[e.kind],
+                                               "触发" if e.active else "解除", f"{e.value:.1f} {ALARM_UNITS[e.kind]}"))
+            win.after(5000, refresh)
+        refresh()
+
     def pick_color(self, var, btn):
         color = colorchooser.askcolor(title="选择线条颜色")[1]
         if color: var.set(color); btn.config(bg=color)
 
     def setup_tree_columns(self):
+        """仪表配置变化时重建列，并清空表格让 update_tree 重新填充"""
+        self.tree.delete(*self.tree.get_children())
+        self.tree_rows = {}     # 整秒时间戳 -> [行 iid, {addr: 温度}]
+        self.tree_seen = {}     # addr -> 已显示到的缓冲累计计数
         cols = ["time"] + [f"addr_{i['addr']}" for i in self.instruments]
         self.tree["columns"] = cols
         self.tree.heading("time", text="时间"); self.tree.column("time", width=220, anchor="center")
@@ -384,89 +2068,249 @@ class App:
             col_id = f"addr_{inst['addr']}"
             self.tree.heading(col_id, text=inst['name']); self.tree.column(col_id, width=150, anchor="center")
 
-    # ================= 数据逻辑 =================
-    def init_db(self):
-        self.conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS records (timestamp REAL, date_str TEXT, time_str TEXT, address INTEGER, temperature REAL)''')
-        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_ts ON records(timestamp)')
-        self.conn.commit()
-
-    def data_loop(self):
-        while self.is_running:
-            start_ts = time.time(); now = datetime.now()
-            port = self.selected_port.get()
-            
-            if port and self.open_serial(port):
-                for inst in self.instruments:
-                    addr = inst['addr']
-                    temp = self.read_temp(addr) 
-                    try:
-                        self.cursor.execute("INSERT INTO records VALUES (?, ?, ?, ?, ?)", 
-                            (now.timestamp(), now.strftime('%Y-%m-%d'), now.strftime('%H:%M:%S'), addr, temp))
-                    except: pass
-                try: self.conn.commit()
-                except: pass
-            else:
-                time.sleep(1)
-
-            elapsed = time.time() - start_ts
-            if elapsed < 1.0: time.sleep(1.0 - elapsed)
+    def plot_window(self):
+        """返回 (数值, 单位, 单位秒数)"""
+        try: val = int(self.plot_duration_val.get())
+        except ValueError: val = 60
+        unit = self.plot_duration_unit.get()
+        if val <= 0: val = 60
+        unit_sec = 60.0 if unit == "分钟" else 3600.0
+        return min(val, int(MAX_PLOT_HOURS * 3600 / unit_sec)), unit, unit_sec
 
     def get_plot_data(self):
         try:
-            val = int(self.plot_duration_val.get()); unit = self.plot_duration_unit.get()
-            if val <= 0: val = 60
-            delta = timedelta(minutes=val) if unit == "分钟" else timedelta(hours=val)
-            start_ts = (datetime.now() - delta).timestamp()
-            self.cursor.execute("SELECT timestamp, address, temperature FROM records WHERE timestamp > ? ORDER BY timestamp ASC", (start_ts,))
-            rows = self.cursor.fetchall()
-            if not rows: return {}, unit, val
-
-            data_map = {i['addr']: {'x': [], 'y': [], 'color': i['color'], 'name': i['name']} for i in self.instruments}
-            now_ts = time.time(); step = 1
-            if len(rows) > MAX_PLOT_POINTS * len(self.instruments): step = len(rows) // (MAX_PLOT_POINTS * len(self.instruments))
-            for i in range(0, len(rows), step):
-                r = rows[i]; addr = r[1]
-                if addr in data_map:
-                    diff = r[0] - now_ts
-                    x_val = diff / 60.0 if unit == "分钟" else diff / 3600.0
-                    data_map[addr]['x'].append(x_val); data_map[addr]['y'].append(r[2])
+            val, unit, unit_sec = self.plot_window()
+            now_ts = time.time(); data_map = {}
+            level = pick_rollup_level(val * unit_sec)
+            for inst in self.instruments:
+                addr = inst['addr']
+                if addr not in self.service.buffers: continue
+                if level is None:
+                    ts, temp = self.service.buffers[addr].since(now_ts - val * unit_sec)
+                    if len(ts) > MAX_PLOT_POINTS: ts, temp = minmax_decimate(ts, temp, temp, MAX_PLOT_POINTS // 2)
+                else:
+                    ts, v = self.service.rollups[addr].buffers[level].since(now_ts - val * unit_sec)
+                    ts, temp = minmax_decimate(ts, v[:, 0], v[:, 1], MAX_PLOT_POINTS // 2)
+                data_map[addr] = {'x': (ts - now_ts) / unit_sec, 'y': temp, 'color': inst['color'], 'name': inst['name']}
             return data_map, unit, val
         except: return {}, "分钟", 60
 
+    def update_status(self):
+        workers = list(self.service.workers.values())
+        if not workers: self.lbl_status.config(text="未选择端口", fg="red"); return
+        ok = all(w.status[1] == "green" for w in workers)
+        self.lbl_status.config(text="  ".join(w.status[0] for w in workers) + f" ({self.protocol_type.get()})", fg="green" if ok else "red")
+
     def update_ui(self):
-        try:
-            self.cursor.execute("SELECT time_str, address, temperature FROM records ORDER BY timestamp DESC LIMIT 100")
-            rows = self.cursor.fetchall(); display_data = {}; ordered_times = []
-            for r in rows:
-                t_str, addr, temp = r[0], r[1], r[2]
-                if t_str not in display_data: display_data[t_str] = {}; ordered_times.append(t_str)
-                display_data[t_str][addr] = temp
-            self.tree.delete(*self.tree.get_children())
-            for t in ordered_times[:20]:
-                row_vals = [t]
-                for inst in self.instruments:
-                    val = display_data[t].get(inst['addr'], "--")
-                    if isinstance(val, float): row_vals.append(f"{val:.1f}")
-                    else: row_vals.append(val)
-                self.tree.insert("", "end", values=row_vals)
-        except: pass
+        self.update_status()
+        t0 = time.perf_counter()
+        try: self.update_tree()
+        except: metrics.inc("yudian_ui_errors_total")
+        t1 = time.perf_counter()
+        self.render_plot()
+        metrics.observe("yudian_ui_render_seconds", t1 - t0, part="tree")
+        metrics.observe("yudian_ui_render_seconds", time.perf_counter() - t1, part="plot")
+        if self.is_running: self.root.after(1000, self.update_ui)
 
-        data_map, unit, limit_val = self.get_plot_data()
-        self.ax.clear()
-        self.ax.set_title(f"多路温度趋势 (最近{limit_val}{unit})", fontsize=PLOT_TITLE_SIZE, pad=15)
+    def update_tree(self):
+        """只把新样本并入表格：新的一秒插在顶部，超出行数从底部删除，开销只与新样本数有关"""
+        changed = set()
+        for inst in self.instruments:
+            addr = inst['addr']; buf = self.service.buffers.get(addr)
+            if buf is None: continue
+            seen = self.tree_seen.get(addr, 0)
+            if seen > buf.count: seen = 0      # 改采样周期后缓冲已重建
+            count, ts, temp = buf.tail(seen, TREE_ROWS)
+            self.tree_seen[addr] = count
+            for t, v in zip(ts, temp):
+                key = int(t); row = self.tree_rows.get(key)
+                if row is None:
+                    if len(self.tree_rows) >= TREE_ROWS and key < min(self.tree_rows): continue
+                    pos = sum(1 for k in self.tree_rows if k > key)
+                    row = self.tree_rows[key] = [self.tree.insert("", pos), {}]
+                row[1][addr] = float(v); changed.add(key)
+        while len(self.tree_rows) > TREE_ROWS:
+            self.tree.delete(self.tree_rows.pop(min(self.tree_rows))[0])
+        for key in changed:
+            if key not in self.tree_rows: continue
+            iid, vals = self.tree_rows[key]
+            row_vals = [datetime.fromtimestamp(key).strftime('%H:%M:%S')]
+            for inst in self.instruments:
+                val = vals.get(inst['addr'])
+                row_vals.append(f"{val:.1f}" if val is not None else "--")
+            self.tree.item(iid, values=row_vals)
+
+    # ================= 曲线绘制 =================
+    def init_plot(self):
+        """窗口显示后再导入 matplotlib 并创建画布"""
+        import matplotlib
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        # --- 字体与显示配置 ---
+        matplotlib.rcParams['font.sans-serif'] = ['SimHei', 'Microsoft YaHei', 'Arial']
+        matplotlib.rcParams['axes.unicode_minus'] = False
+        self.fig, self.ax = plt.subplots()
+        self.fig.subplots_adjust(bottom=0.15, left=0.08, right=0.95, top=0.90) 
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.graph_frame)
+        self.canvas.get_tk_widget().pack(fill="both", expand=True)
+        # 曲线用 animated 艺术家 + blit 增量刷新；坐标轴/图例只在仪表列表或绘图范围变化时重建
+        self.canvas.mpl_connect('draw_event', self.on_plot_draw)
+        # 滚轮缩放、左键拖动平移 (会自动进入历史浏览)
+        self.canvas.mpl_connect('scroll_event', self.on_history_scroll)
+        self.canvas.mpl_connect('button_press_event', self.on_history_press)
+        self.canvas.mpl_connect('motion_notify_event', self.on_history_drag)
+        self.canvas.mpl_connect('button_release_event', self.on_history_release)
+
+    def render_plot(self):
+        """数据没变就不画；只有曲线变化时 blit 曲线，坐标范围/配置变化才整图重绘"""
+        if self.canvas is None or self.history_view is not None: return
+        val, unit, unit_sec = self.plot_window()
+        key = (val, unit, tuple((i['addr'], i['name'], i['color']) for i in self.instruments))
+        level = pick_rollup_level(val * unit_sec)
+        full = key != self.plot_key
+        if full: self.rebuild_plot(key)
+        version = (level, tuple((self.service.buffers[i[0]].count if level is None else self.service.rollups[i[0]].buffers[level].count)
+                                if i[0] in self.service.buffers else -1 for i in key[2]))
+        if not full and version == self.plot_version: return
+        self.plot_version = version
+
+        data_map, unit, val = self.get_plot_data()
+        ys = []
+        for addr, line in self.lines.items():
+            d = data_map.get(addr)
+            if d is None: line.set_data([], []); continue
+            line.set_data(d['x'], d['y'])
+            if len(d['y']): ys.append((float(np.min(d['y'])), float(np.max(d['y']))))
+        if ys:
+            lo = min(y[0] for y in ys); hi = max(y[1] for y in ys)
+            y0, y1 = self.ax.get_ylim()
+            # 数据超出纵轴，或纵轴比应有范围 (含边距) 大一倍以上时才重新设定，数据平稳时不必整图重绘
+            margin = max(0.5, (hi - lo) * 0.05)
+            if lo < y0 or hi > y1 or (y1 - y0) > 2 * ((hi - lo) + 2 * margin):
+                self.ax.set_ylim(lo - margin, hi + margin); full = True
+        if full or self.plot_background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.plot_background)
+            for line in self.lines.values(): self.ax.draw_artist(line)
+            self.canvas.blit(self.ax.bbox)
+
+    def rebuild_plot(self, key):
+        val, unit = key[0], key[1]
+        self.ax.clear(); self.lines = {}; self.plot_version = None
+        self.ax.set_title(f"多路温度趋势 (最近{val}{unit})", fontsize=PLOT_TITLE_SIZE, pad=15)
         self.ax.set_xlabel(f"时间 ({unit}前)", fontsize=PLOT_LABEL_SIZE)
         self.ax.set_ylabel("温度 (°C)", fontsize=PLOT_LABEL_SIZE)
         self.ax.tick_params(labelsize=PLOT_TICK_SIZE); self.ax.grid(True, linestyle='--', alpha=0.5)
-        has_data = False
-        for addr, d in data_map.items():
-            if d['x']: has_data = True; self.ax.plot(d['x'], d['y'], color=d['color'], label=d['name'], linewidth=1.5)
-        if has_data: self.ax.legend(loc='upper left', fontsize=12, ncol=3); self.ax.set_xlim(-limit_val, 0)
-        self.canvas.draw()
-        if self.is_running: self.root.after(1000, self.update_ui)
+        for inst in self.instruments:
+            self.lines[inst['addr']], = self.ax.plot([], [], color=inst['color'], label=inst['name'], linewidth=1.5, animated=True)
+        if self.lines: self.ax.legend(loc='upper left', fontsize=12, ncol=3)
+        self.ax.set_xlim(-val, 0)
+        self.plot_key = key
+
+    def on_plot_draw(self, event):
+        """整图重绘 (含窗口缩放) 后保存不含曲线的背景，再把曲线画上"""
+        if self.history_view is not None: return
+        self.plot_background = self.canvas.copy_from_bbox(self.ax.bbox)
+        for line in self.lines.values(): self.ax.draw_artist(line)
+
+    # ================= 历史浏览 =================
+    def toggle_history(self):
+        if self.history_view is None: self.enter_history()
+        else: self.exit_history()
+
+    def enter_history(self):
+        """冻结实时曲线，横轴改为绝对时间，初始范围与当前实时窗口相同"""
+        if self.canvas is None: return
+        from matplotlib.ticker import FuncFormatter
+        val, unit, unit_sec = self.plot_window(); now = time.time()
+        self.history_view = (now - val * unit_sec, now)
+        self.btn_history.config(text="返回实时")
+        self.ax.clear(); self.lines = {}; self.plot_key = None
+        self.ax.set_xlabel("时间 (滚轮缩放，左键拖动平移)", fontsize=PLOT_LABEL_SIZE)
+        self.ax.set_ylabel("温度 (°C)", fontsize=PLOT_LABEL_SIZE)
+        self.ax.tick_params(labelsize=PLOT_TICK_SIZE); self.ax.grid(True, linestyle='--', alpha=0.5)
+        self.ax.xaxis.set_major_formatter(FuncFormatter(self.format_history_tick))
+        self.load_history()
+
+    def exit_history(self):
+        self.history_view = None; self.history_drag = None
+        self.btn_history.config(text="历史浏览")
+        self.plot_key = None    # 下次 render_plot 重建实时坐标轴
+        self.render_plot()
+
+    def format_history_tick(self, x, pos=None):
+        span = self.history_view[1] - self.history_view[0] if self.history_view else 0
+        fmt = "%m-%d\n%H:%M" if span > 86400 else ("%H:%M" if span > 600 else "%H:%M:%S")
+        try: return datetime.fromtimestamp(x).strftime(fmt)
+        except (OverflowError, OSError, ValueError): return ""
+
+    def set_history_view(self, t0, t1):
+        """限制在有数据的范围内 (含归档) 并合并连续的请求：拖动/滚轮时只在空闲时重画一次"""
+        now = time.time(); oldest = min(now - MAX_PLOT_HOURS * 3600, self.db.oldest() or now)
+        span = min(max(t1 - t0, MIN_VIEW_SECONDS), now - oldest)
+        t0 = min(max(t0, oldest), now - span)
+        self.history_view = (t0, t0 + span)
+        if not self.history_pending:
+            self.history_pending = True; self.root.after(30, self.load_history)
+
+    def load_history(self):
+        """只取可见仪表在可见范围内的数据，分辨率按画布像素宽度选择 (原始或某级汇总)"""
+        self.history_pending = False
+        if self.history_view is None: return
+        t_start = time.perf_counter()
+        t0, t1 = self.history_view
+        width = max(100, int(self.ax.bbox.width))
+        level = pick_rollup_level(t1 - t0, width)
+        if set(self.lines) != {i['addr'] for i in self.instruments}:
+            for line in self.lines.values(): line.remove()
+            self.lines = {}
+            for inst in self.instruments:
+                self.lines[inst['addr']], = self.ax.plot([], [], color=inst['color'], label=inst['name'], linewidth=1.5)
+            if self.lines: self.ax.legend(loc='upper left', fontsize=12, ncol=3)
+        ys = []
+        for inst in self.instruments:
+            ts, vmin, vmax = self.tiles.get(inst['addr'], level, t0, t1, settle_seconds(inst))
+            x, y = minmax_decimate(ts, vmin, vmax, width)
+            self.lines[inst['addr']].set_data(x, y)
+            if len(y): ys.append((float(np.min(y)), float(np.max(y))))
+        if ys:
+            lo = min(y[0] for y in ys); hi = max(y[1] for y in ys); margin = max(0.5, (hi - lo) * 0.05)
+            self.ax.set_ylim(lo - margin, hi + margin)
+        self.ax.set_xlim(t0, t1)
+        res = "原始数据" if level is None else f"{level}秒汇总"
+        self.ax.set_title(f"历史数据 {datetime.fromtimestamp(t0):%m-%d %H:%M} ~ {datetime.fromtimestamp(t1):%m-%d %H:%M} ({res})", fontsize=PLOT_TITLE_SIZE, pad=15)
+        self.canvas.draw_idle()
+        metrics.observe("yudian_ui_render_seconds", time.perf_counter() - t_start, part="history")
+
+    def history_fraction(self, event):
+        """鼠标在绘图区横向的位置 (0~1)，与当前坐标系无关"""
+        bbox = self.ax.bbox
+        return min(1.0, max(0.0, (event.x - bbox.x0) / bbox.width))
+
+    def on_history_scroll(self, event):
+        if event.inaxes is not self.ax: return
+        if self.history_view is None: self.enter_history()
+        t0, t1 = self.history_view; factor = 1 / 1.5 if event.button == 'up' else 1.5
+        center = t0 + (t1 - t0) * self.history_fraction(event)
+        self.set_history_view(center - (center - t0) * factor, center + (t1 - center) * factor)
+
+    def on_history_press(self, event):
+        if event.inaxes is not self.ax or event.button != 1: return
+        if self.history_view is None: self.enter_history()
+        self.history_drag = (event.x, self.history_view)
+
+    def on_history_drag(self, event):
+        if self.history_drag is None or self.history_view is None: return
+        x0, (t0, t1) = self.history_drag
+        shift = -(event.x - x0) / self.ax.bbox.width * (t1 - t0)
+        self.set_history_view(t0 + shift, t1 + shift)
+
+    def on_history_release(self, event):
+        self.history_drag = None
 
     def export_data(self):
+        if self.exporter is not None and self.exporter.is_alive(): messagebox.showwarning("提示", "正在导出，请稍候"); return
         mode = self.export_mode.get()
         start_dt, end_dt = None, None
         try:
@@ -474,18 +2318,37 @@ class App:
                 h = float(self.recent_hours.get()); end_dt = datetime.now(); start_dt = end_dt - timedelta(hours=h)
             else:
                 fmt = "%Y-%m-%d %H:%M"; start_dt = datetime.strptime(self.start_time_str.get(), fmt); end_dt = datetime.strptime(self.end_time_str.get(), fmt)
-            query = "SELECT date_str, time_str, address, temperature FROM records WHERE timestamp BETWEEN ? AND ? ORDER BY timestamp ASC"
-            df = pd.read_sql_query(query, self.conn, params=(start_dt.timestamp(), end_dt.timestamp()))
-            if df.empty: messagebox.showwarning("空", "无数据"); return
-            df['DateTime'] = df['date_str'] + " " + df['time_str']
-            pivot_df = df.pivot_table(index=['date_str', 'time_str'], columns='address', values='temperature', aggfunc='first')
-            new_cols = []; name_map = {i['addr']: i['name'] for i in self.instruments}
-            for addr in pivot_df.columns: new_cols.append(name_map.get(addr, f"Addr_{addr}"))
-            pivot_df.columns = new_cols; pivot_df.reset_index(inplace=True) 
-            fname = filedialog.asksaveasfilename(initialfile=f"{start_dt.strftime('%Y%m%d %H%M')}-{end_dt.strftime('%Y%m%d %H%M')} 多路温度.csv", filetypes=[("CSV", "*.csv")])
-            if fname: pivot_df.to_csv(fname, index=False, encoding="utf-8-sig"); messagebox.showinfo("成功", "导出成功")
+            addrs = self.db.addresses(start_dt.timestamp(), end_dt.timestamp())
+            if not addrs: messagebox.showwarning("空", "无数据"); return
+            name_map = {i['addr']: i['name'] for i in self.instruments}
+            columns = [(addr, name_map.get(addr, f"Addr_{addr}")) for addr in addrs]
+            step = min([inst_interval(i) for i in self.instruments if i['addr'] in addrs] + [1.0])
+            fname = filedialog.asksaveasfilename(initialfile=f"{start_dt.strftime('%Y%m%d %H%M')}-{end_dt.strftime('%Y%m%d %H%M')} 多路温度.csv",
+                                                 filetypes=[("CSV", "*.csv"), ("CSV (gzip 压缩)", "*.csv.gz"), ("Parquet", "*.parquet")])
+            if not fname: return
+            resample = {i['addr']: self.service.resample_spec(i) for i in self.instruments if compression_spec(i)}
+            self.exporter = Exporter(self.db, fname, columns, start_dt.timestamp(), end_dt.timestamp(), step, resample)
+            self.exporter.start()
+            self.show_export_progress(self.exporter)
         except Exception as e: messagebox.showerror("错误", str(e))
 
+    def show_export_progress(self, exporter):
+        """导出进度窗口：定时查询后台线程的进度，可随时取消"""
+        win = tk.Toplevel(self.root); win.title("导出数据"); win.geometry("700x250")
+        lbl = tk.Label(win, text="正在导出...", font=("微软雅黑", 18)); lbl.pack(pady=20)
+        bar = ttk.Progressbar(win, length=600, maximum=100); bar.pack(pady=10)
+        tk.Button(win, text="取消", font=("微软雅黑", 16), command=exporter.cancel).pack(pady=10)
+        win.protocol("WM_DELETE_WINDOW", exporter.cancel)
+        def poll():
+            if exporter.is_alive():
+                bar['value'] = exporter.progress * 100; lbl.config(text=f"正在导出... 已写 {exporter.rows_written} 行")
+                win.after(200, poll); return
+            win.destroy()
+            if exporter.error is not None: messagebox.showerror("错误", str(exporter.error))
+            elif exporter.cancel_event.is_set(): messagebox.showinfo("提示", "导出已取消")
+            else: messagebox.showinfo("成功", f"导出成功，共 {exporter.rows_written} 行")
+        poll()
+
     def validate_number(self, val): return val.isdigit() or val == ""
     def show_help(self): messagebox.showinfo("说明", "后台运行版\n点击右上角关闭按钮会最小化到托盘\n右键托盘图标可退出系统")
     def show_about(self):
@@ -494,14 +2357,46 @@ class App:
         tk.Label(top, text="中国科学院大连化学物理研究所，马军制作", font=("微软雅黑", 18)).pack()
         tk.Label(top, text="novaium@qq.com", font=("Arial", 14), fg="blue").pack(pady=10)
     def refresh_ports(self):
+        import serial.tools.list_ports
         ports = sorted(list(set([p.device for p in serial.tools.list_ports.comports()] + ["COM1","COM2","COM3","COM4"])))
         self.cb_ports['values'] = ports; 
         if ports: self.cb_ports.current(0)
-    def cleanup_old_data(self):
-        try: t = (datetime.now()-timedelta(days=DATA_RETENTION_DAYS)).timestamp(); self.cursor.execute("DELETE FROM records WHERE timestamp < ?", (t,)); self.conn.commit()
-        except: pass
 
-if __name__ == "__main__":
+def run_headless(service):
+    """无界面采集：只跑串口轮询和写库，Ctrl+C 或 SIGTERM 退出"""
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *a: stop.set())
+    ports = sorted(set(service.inst_port(i) for i in service.instruments) - {""})
+    if not ports: log.warning("没有可用串口：请用 --port 指定，或在配置文件中为仪表填写 port")
+    log.info("无界面采集启动：%d 台仪表，串口 %s，数据库 %s", len(service.instruments), ", ".join(ports) or "-", service.db.path)
+    service.start()
+    try:
+        while not stop.wait(1): pass
+    except KeyboardInterrupt: pass
+    log.info("正在停止...")
+    service.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="宇电 AI 系列仪表温度采集")
+    parser.add_argument("--headless", action="store_true", help="不启动界面，只在后台采集并写入数据库")
+    parser.add_argument("--port", default="", help="默认串口 (仪表未单独配置 port 时使用)")
+    parser.add_argument("--protocol", default="AIBUS", choices=["AIBUS", "MODBUS"], help="默认通讯协议")
+    parser.add_argument("--db", default=DB_FILE, help="数据库文件")
+    parser.add_argument("--config", default=CONFIG_FILE, help="仪表配置文件")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="本机 Prometheus 指标端口，0 表示不开启")
+    parser.add_argument("--pubsub-port", type=int, default=PUBSUB_PORT, help="本机实时数据发布端口，0 表示不开启")
+    parser.add_argument("--archive", default=None, help="超出保留期数据的归档目录 (默认 数据库名_archive)，空字符串表示直接删除")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    service = Service(load_config(args.config), args.port, args.protocol, args.db, args.config, args.metrics_port, args.pubsub_port, args.archive)
+    if args.headless:
+        run_headless(service)
+        return
+    import_tk()
     root = tk.Tk()
-    app = App(root)
-    root.mainloop()
\ No newline at end of file
+    app = App(root, service)
+    root.mainloop()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file